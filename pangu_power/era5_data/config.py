@@ -39,6 +39,8 @@ __C.LSM_PATH = (
 __C.MEAN_POWER_PATH = (
     "/lsdf/kit/imk-tro/projects/Gruppe_Quinting/om1434/mean_power_per_grid_point.npy"
 )
+# Pre-packed sample store (see energy_dataset.pack_energy_dataset). If empty, samples are read from the zarr stores above
+__C.PACKED_DATA_PATH = ""
 __C.POWER_CURVE_PATH = "/lsdf/kit/imk-tro/projects/Gruppe_Quinting/om1434/power_curves/wind_turbine_power_curves.csv"
 
 # Pangu pre-inferenced outputs: outputs that have been pre-inferenced with Pangu and are used for visualization
@@ -68,6 +70,49 @@ __C.PG = ConfigNamespace()
 __C.PG.HORIZON = 24  # Forecast horizon
 # Use land sea mask when calculating loss (set for all: train, val, test)
 __C.PG.USE_LSM = True
+# Precision of model inference in training, validation and testing: "fp32", "bf16" or "fp16" (autocast).
+# LayerNorms, the input normalization and the clipped ReLU outputs stay in fp32. fp16 training uses a GradScaler
+__C.PG.PRECISION = "fp32"
+# Window attention implementation of EarthAttention3D:
+# - "math": explicit attention scores, bias/mask adds and softmax (original implementation)
+# - "sdpa": torch.nn.functional.scaled_dot_product_attention with the Earth-specific bias and shift mask as one additive mask
+__C.PG.ATTENTION_BACKEND = "math"
+# Precompute the sum of the Earth-specific bias and the shift mask once per rolled block while the bias is constant
+# (frozen or gradients disabled), each rolled block then adds a single buffer in place. Costs ~60 MB per rolled block
+__C.PG.CACHE_ATTENTION_BIAS = True
+# Activation checkpointing of the EarthSpecificBlocks, only applied when gradients flow through a block:
+# - "none": no checkpointing
+# - "all": every block (original behaviour)
+# - "every_other": the unrolled blocks (every second block)
+# - "attention": only the window attention of every block
+__C.PG.CHECKPOINT_POLICY = "all"
+# Compile the EarthSpecificBlocks with torch.compile (first iterations are slower while compiling)
+__C.PG.COMPILE = False
+# Partition the tokens into attention windows (incl. padding and roll) with one scatter and reverse them with one
+# gather of precomputed indices, instead of the pad/roll/permute copies of the original implementation
+__C.PG.GATHER_WINDOW_PARTITION = True
+# Fold the input normalization into the patch embedding weights and precompute the constant part (normalization
+# offsets, constant masks, conv biases) as a bias of the embedding. Only used while the embedding is frozen. The bias
+# ([1, 521280, 192] in fp32, ~400 MB) stays resident on the device of the model, set to False if memory is tight
+__C.PG.FOLD_PATCH_EMBEDDING = True
+
+# Cache of the outputs of the frozen model part (see models.feature_cache), training and validation then only run
+# the trainable head. Requires a model type that only trains its head and POWER.LORA == False
+__C.PG.FEATURE_CACHE = ConfigNamespace()
+__C.PG.FEATURE_CACHE.ENABLED = False
+# The cache is stored below this path per model type and per key of the frozen weights and configuration (see
+# feature_cache.cache_key), features of other weights are never reused
+__C.PG.FEATURE_CACHE.PATH = os.path.join(__C.PG_OUT_PATH, "feature_cache")
+
+# DataLoader settings (set for all: train, val, test)
+# Number of worker processes reading samples, each worker reopens the zarr stores (0 reads on the main process)
+__C.PG.NUM_WORKERS = 4
+# Number of batches loaded in advance by each worker (only used if NUM_WORKERS > 0)
+__C.PG.PREFETCH_FACTOR = 2
+# Keep workers (and their open datasets) alive between epochs (only used if NUM_WORKERS > 0)
+__C.PG.PERSISTENT_WORKERS = True
+# Collate batches into page-locked memory, enables asynchronous host-to-device copies
+__C.PG.PIN_MEMORY = torch.cuda.is_available()
 
 __C.PG.TRAIN = ConfigNamespace()
 __C.PG.TRAIN.EPOCHS = 100
@@ -81,6 +126,8 @@ __C.PG.TRAIN.UPPER_WEIGHTS = [3.00, 0.60, 1.50, 0.77, 0.54]
 __C.PG.TRAIN.SURFACE_WEIGHTS = [1.50, 0.77, 0.66, 3.00]
 __C.PG.TRAIN.SAVE_INTERVAL = 5
 __C.PG.TRAIN.USE_LSM = __C.PG.USE_LSM
+# Whether samples contain the target ERA5 fields (only required for visualization)
+__C.PG.TRAIN.LOAD_TARGET_ERA5 = False
 
 __C.PG.VAL = ConfigNamespace()
 __C.PG.VAL.START_TIME = "20170101"
@@ -89,6 +136,8 @@ __C.PG.VAL.FREQUENCY = "48h"
 __C.PG.VAL.BATCH_SIZE = 1
 __C.PG.VAL.INTERVAL = 1
 __C.PG.VAL.USE_LSM = __C.PG.USE_LSM
+# Only one validation step is visualized, its target ERA5 fields are loaded on demand
+__C.PG.VAL.LOAD_TARGET_ERA5 = False
 
 __C.PG.TEST = ConfigNamespace()
 __C.PG.TEST.START_TIME = "20180101"
@@ -97,6 +146,15 @@ __C.PG.TEST.END_TIME = "20181231"
 __C.PG.TEST.FREQUENCY = "48h"
 __C.PG.TEST.BATCH_SIZE = 1
 __C.PG.TEST.USE_LSM = __C.PG.USE_LSM
+# Every test step is visualized, the ERA5 fields that are not in the samples are loaded on demand
+__C.PG.TEST.VISUALIZE = True
+__C.PG.TEST.LOAD_TARGET_ERA5 = True
+# The formula baseline reads the pangu forecasts from PANGU_INFERENCE_OUTPUTS (see train_power.save_output_pth)
+# instead of running pangu for every test step, the test samples then only contain the power fields
+__C.PG.TEST.STORED_PANGU_OUTPUTS = False
+# The test scores are accumulated on the device (see power_metrics.PowerScoreAccumulator) and copied to the host every
+# METRIC_SYNC_INTERVAL batches, 0 only copies them at the end of the test
+__C.PG.TEST.METRIC_SYNC_INTERVAL = 0
 
 # Shorten training for testing purposes
 __C.PG.TRAIN.EPOCHS = 5
@@ -130,6 +188,29 @@ __C.POWER.CHECKPOINT = ""
 # - PanguPowerConvSigmoid: Same as PanguPowerConv but with a sigmoid activation function at the end
 __C.POWER.MODEL_TYPE = "PanguPowerConv"
 
+# Region of interest (ROI) mode: the power heads only compute the Europe bounding box of the land-sea mask (same area as
+# utils.prepare_europe). Outputs are [B, 1, 185, 271] and are only scattered back onto the [721, 1440] grid when a full
+# map is needed (visualization, test scores). Works with PanguPowerPatchRecovery and PanguPowerConv(Sigmoid)
+# Note: in training mode the BatchNorm layers of PanguPowerConv(Sigmoid) normalize with the statistics of the ROI (and
+# its halo) instead of the full grid, and their running statistics are those of the ROI. Training in ROI mode is
+# therefore not equivalent to training on the full grid, and ROI-trained checkpoints should be used with ROI = True
+__C.POWER.ROI = False
+# Rows [start, stop) and columns [start, stop) of the ROI on the [721, 1440] grid, negative columns wrap around the dateline
+__C.POWER.ROI_ROWS = (70, 255)
+__C.POWER.ROI_COLS = (-88, 183)
+
+# Formula baseline (see BaselineFormula.forward_all): hub heights [m] the 10 m wind speed is extrapolated to with the
+# power law ws(h) = ws(10 m) * (h / 10 m) ** WIND_SHEAR_EXPONENT
+__C.POWER.HUB_HEIGHTS = [100, 150]
+__C.POWER.WIND_SHEAR_EXPONENT = 1 / 7
+# Evaluate the power curve of the formula baseline with a lookup table on a uniform wind speed grid (one multiply,
+# floor and gather) instead of searchsorted. Same results for power curves whose knots lie on the grid (CURVE_LUT_STEP
+# [m/s]), also at the cut-out (see BaselineFormula._build_lut)
+__C.POWER.CURVE_LUT = True
+__C.POWER.CURVE_LUT_STEP = 0.5
+# Power curve of the formula baseline: offshore (POWER_CURVE_OFFSHORE) or onshore (loadWindPowerCurve(offshore=False))
+__C.POWER.OFFSHORE_CURVE = True
+
 
 # ***** LORA *****
 # Contains hyperparameters for LORA. Works best with MODEL_TYPE="PanguPowerPatchRecovery".
@@ -144,7 +225,14 @@ __C.LORA.LORA_DROPOUT = 0.1
 # ***** PowerConv *****
 # Contains hyperparameters for PanguPowerConv
 __C.POWERCONV = ConfigNamespace()
+# Variables the power head uses (subsets of ERA5_UPPER_VARIABLES and ERA5_SURFACE_VARIABLES, in that order)
+__C.POWERCONV.UPPER_VARIABLES = ["u", "v"]
+__C.POWERCONV.SURFACE_VARIABLES = ["u10", "v10"]
+# u and v for 13 pressure levels, u10m, v10m
 __C.POWERCONV.IN_CHANNELS = 28
+assert __C.POWERCONV.IN_CHANNELS == len(__C.POWERCONV.UPPER_VARIABLES) * len(
+    __C.ERA5_UPPER_LEVELS
+) + len(__C.POWERCONV.SURFACE_VARIABLES)
 __C.POWERCONV.OUT_CHANNELS = [4, 1]
 __C.POWERCONV.KERNEL_SIZE = 1
 __C.POWERCONV.STRIDE = 1
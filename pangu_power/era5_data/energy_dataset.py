@@ -1,11 +1,65 @@
-from typing import List, Tuple
+import os
+import argparse
+import logging
+from typing import Dict, List, Optional, Tuple
 import xarray as xr
 import pandas as pd
 import random
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from datetime import datetime, timedelta
 
+from ..era5_data.config import cfg
+
+logger = logging.getLogger(__name__)
+
+
+class PackedSampleStore:
+    """Flat memory-mapped store of model-ready fields, indexed by timestamp.
+
+    Every timestamp is stored once, so an input at t and a target at t + horizon are two rows of the same store.
+    The store is a directory containing:
+    - times.npy: timestamps as "%Y%m%d%H" strings, row i of the arrays belongs to times[i]
+    - upper.npy: (T, 5, 13, 721, 1440) float32, levels already reversed (as returned by EnergyDataset._xr_era5_to_numpy)
+    - surface.npy: (T, 4, 721, 1440) float32
+    - power.npy: (T, 1, 721, 1440) float32, already reindexed onto the ERA5 grid with NaNs filled with 0
+    """
+
+    SHAPES = {
+        "upper": (5, 13, 721, 1440),
+        "surface": (4, 721, 1440),
+        "power": (1, 721, 1440),
+    }
+
+    def __init__(self, path: str) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            Directory of the store, as written by `pack_energy_dataset`.
+        """
+        self.path = path
+        times = np.load(os.path.join(path, "times.npy"))
+        self.index: Dict[str, int] = {str(t): i for i, t in enumerate(times)}
+
+        # Copy-on-write maps: rows are served as writable views without ever touching the files
+        self.arrays: Dict[str, np.ndarray] = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c")
+            for name in self.SHAPES
+        }
+
+    def __contains__(self, time: datetime) -> bool:
+        return time.strftime("%Y%m%d%H") in self.index
+
+    def get(self, time: datetime) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns zero-copy views of the upper, surface and power fields at the given time."""
+        i = self.index[time.strftime("%Y%m%d%H")]
+        return (
+            self.arrays["upper"][i],
+            self.arrays["surface"][i],
+            self.arrays["power"][i],
+        )
+
 
 class EnergyDataset(Dataset):
     def __init__(
@@ -17,6 +71,9 @@ class EnergyDataset(Dataset):
         freq="h",
         horizon=24,
         seed=1234,
+        packed_path: Optional[str] = None,
+        load_target_era5: bool = True,
+        load_input_era5: bool = True,
     ) -> None:
         """
         Parameters
@@ -25,10 +82,26 @@ class EnergyDataset(Dataset):
             Filepath to the ERA5 dataset (zarr).
         filephath_power : str
             Filepath to the power dataset (zarr).
+        packed_path : Optional[str], optional
+            Directory of a pre-packed sample store (see `pack_energy_dataset`). If set, samples are served as
+            memory-mapped views from that store and the zarr datasets are not opened. By default None.
+        load_target_era5 : bool, optional
+            Whether samples contain the target upper and surface ERA5 fields, by default True. If False, only the
+            target power is read at the target time and empty arrays are returned in place of the target ERA5
+            fields, they can be loaded on demand with `load_era5` (e.g. for visualization).
+        load_input_era5 : bool, optional
+            Whether samples contain the input upper and surface ERA5 fields, by default True. If False, only the
+            input power is read at the input time, with empty arrays in place of the input ERA5 fields (e.g. for
+            baselines that do not run pangu).
         """
-        # Load ERA5 and power datasets
-        self.era5_upper, self.era5_surface = self._get_era5_data(filepath_era5)
-        self.power = self._load_power_data(filepath_power)
+        self.filepath_era5 = filepath_era5
+        self.filepath_power = filepath_power
+        self.packed_path = packed_path
+        self.load_target_era5 = load_target_era5
+        self.load_input_era5 = load_input_era5
+
+        # Load ERA5 and power datasets (or the packed store)
+        self.open()
 
         # Generate list of datetime keys based on the specified range and frequency
         self.keys = list(pd.date_range(start=startDate, end=endDate, freq=freq))
@@ -40,6 +113,42 @@ class EnergyDataset(Dataset):
         # Set the random seed for reproducibility
         random.seed(seed)
 
+    # Open file handles, they are not pickled but reopened in each DataLoader worker (see worker_init_fn)
+    _HANDLES = (
+        "packed",
+        "era5_upper",
+        "era5_surface",
+        "power",
+        "power_grid",
+        "power_lat_index",
+        "power_lon_index",
+    )
+
+    def open(self) -> None:
+        """Opens the xarray datasets (or the packed store) of this dataset."""
+        if self.packed_path:
+            self.packed = PackedSampleStore(self.packed_path)
+        else:
+            self.era5_upper, self.era5_surface = self._get_era5_data(self.filepath_era5)
+            self.power = self._load_power_data(self.filepath_power)
+
+            # Integer mapping of the power grid onto the ERA5 grid, replaces the per-sample reindexing
+            (
+                self.power_grid,
+                self.power_lat_index,
+                self.power_lon_index,
+            ) = self._align_power_grid(self.power, self.era5_surface)
+
+        self.is_open = True
+
+    def __getstate__(self) -> dict:
+        """Drops the file handles when the dataset is sent to DataLoader workers."""
+        state = self.__dict__.copy()
+        for handle in self._HANDLES:
+            state.pop(handle, None)
+        state["is_open"] = False
+        return state
+
     def _load_data(
         self, key: datetime
     ) -> Tuple[
@@ -79,39 +188,20 @@ class EnergyDataset(Dataset):
         end_time = key + timedelta(hours=self.horizon)
         end_time_str = end_time.strftime("%Y%m%d%H")
 
-        # Get era5 datasets (input)
-        input_surface_dataset = self.era5_surface.sel(time=start_time)
-        input_upper_dataset = self.era5_upper.sel(time=start_time)
-        target_surface_dataset = self.era5_surface.sel(time=end_time)
-        target_upper_dataset = self.era5_upper.sel(time=end_time)
-
-        # Get power datasets (target) and force the target dataset to have the same longitudes as the input dataset
-        input_dataset_power = self.power.sel(time=start_time)
-        input_dataset_power = input_dataset_power.reindex(
-            longitude=input_surface_dataset["longitude"].values,
-            latitude=input_surface_dataset["latitude"].values,
-            method=None,
-        )
-        input_dataset_power = input_dataset_power.fillna(0)
-
-        target_dataset_power = self.power.sel(time=end_time)
-        target_dataset_power = target_dataset_power.reindex(
-            longitude=input_surface_dataset["longitude"].values,
-            latitude=input_surface_dataset["latitude"].values,
-            method=None,
-        )
-        target_dataset_power = target_dataset_power.fillna(0)
-
-        # datasets to numpy
-        input, input_surface = self._xr_era5_to_numpy(
-            input_upper_dataset, input_surface_dataset
-        )
-        target_upper, target_surface = self._xr_era5_to_numpy(
-            target_upper_dataset, target_surface_dataset
-        )
-
-        input_power = self._xr_power_to_numpy(input_dataset_power)
-        target_power = self._xr_power_to_numpy(target_dataset_power)
+        if self.load_input_era5:
+            input, input_surface, input_power = self._load_fields(start_time)
+        else:
+            # Placeholders like those of the target ERA5 fields
+            input = np.empty((0,), dtype=np.float32)
+            input_surface = np.empty((0,), dtype=np.float32)
+            input_power = self._load_power_field(start_time)
+        if self.load_target_era5:
+            target_upper, target_surface, target_power = self._load_fields(end_time)
+        else:
+            # Placeholders keep the tuple layout, they collate to empty (B, 0) tensors
+            target_upper = np.empty((0,), dtype=np.float32)
+            target_surface = np.empty((0,), dtype=np.float32)
+            target_power = self._load_power_field(end_time)
 
         return (
             input,
@@ -123,6 +213,101 @@ class EnergyDataset(Dataset):
             (start_time_str, end_time_str),
         )
 
+    def _load_fields(self, time: datetime) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Load the model-ready upper, surface and power fields of a single timestamp.
+
+        Served as memory-mapped views if a packed store is used, otherwise read from the zarr datasets.
+        The power sub-grid is scattered onto the ERA5 grid (see `_load_power`).
+
+        Parameters
+        ----------
+        time : datetime
+            The timestamp to load.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray]
+            Upper (5, 13, 721, 1440), surface (4, 721, 1440) and power (1, 721, 1440) arrays.
+        """
+        if not self.is_open:
+            self.open()
+
+        if self.packed_path:
+            return self.packed.get(time)
+
+        # Get era5 datasets
+        surface_dataset = self.era5_surface.sel(time=time)
+        upper_dataset = self.era5_upper.sel(time=time)
+
+        # datasets to numpy
+        upper, surface = self._xr_era5_to_numpy(upper_dataset, surface_dataset)
+        power = self._load_power(time)
+
+        return upper, surface, power
+
+    def _load_power_field(self, time: datetime) -> np.ndarray:
+        """Load only the power field of a single timestamp (see `_load_fields`)."""
+        if not self.is_open:
+            self.open()
+
+        if self.packed_path:
+            return self.packed.get(time)[2]
+        return self._load_power(time)
+
+    def load_era5(self, time: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Load the upper and surface ERA5 fields of a single timestamp on demand.
+
+        Used to get the target fields of datasets created with `load_target_era5=False`.
+
+        Parameters
+        ----------
+        time : str
+            The timestamp in "%Y%m%d%H" format (as returned in the periods of a sample).
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Upper (5, 13, 721, 1440) and surface (4, 721, 1440) arrays.
+        """
+        if not self.is_open:
+            self.open()
+
+        time_obj = datetime.strptime(time, "%Y%m%d%H")
+        if self.packed_path:
+            upper, surface, _ = self.packed.get(time_obj)
+            return upper, surface
+
+        return self._xr_era5_to_numpy(
+            self.era5_upper.sel(time=time_obj), self.era5_surface.sel(time=time_obj)
+        )
+
+    def _load_power(self, time: datetime) -> np.ndarray:
+        """
+        Load the power capacity factors of a single timestamp on the ERA5 grid.
+
+        Equivalent to reindexing the power dataset onto the ERA5 coordinates and filling NaNs with 0, but
+        only the power sub-grid is read and it is placed with a single fancy-index scatter.
+
+        Parameters
+        ----------
+        time : datetime
+            The timestamp to load.
+
+        Returns
+        -------
+        np.ndarray
+            Power capacity factors of shape (1, 721, 1440), 0 outside of the power grid.
+        """
+        values = self.power_grid.sel(time=time).values.astype(np.float32)
+
+        power = np.zeros((1, 721, 1440), dtype=np.float32)
+        power[0][np.ix_(self.power_lat_index, self.power_lon_index)] = np.nan_to_num(
+            values, nan=0.0
+        )
+        return power
+
     def __getitem__(
         self, index: int
     ) -> Tuple[
@@ -210,19 +395,45 @@ class EnergyDataset(Dataset):
         return upper, surface
 
     @staticmethod
-    def _xr_power_to_numpy(dataset):
-        """
-        Input
-            xr.Dataset power
-        Return
-            numpy array power
+    def _align_power_grid(
+        power: xr.Dataset, era5: xr.Dataset
+    ) -> Tuple[xr.DataArray, np.ndarray, np.ndarray]:
         """
+        Computes the integer mapping of the power grid onto the ERA5 grid (once, at construction).
 
-        power = dataset["wofcfr"].values.astype(np.float32)
-        power = power[np.newaxis, ...]
-        assert power.shape == (1, 721, 1440)
+        Coordinates are matched by exact label, like `reindex(method=None)`. Power grid points that do not exist
+        on the ERA5 grid are dropped, ERA5 grid points without power data stay 0.
 
-        return power
+        Parameters
+        ----------
+        power : xr.Dataset
+            The power dataset (longitudes in [0, 360)).
+        era5 : xr.Dataset
+            An ERA5 dataset providing the target latitude and longitude coordinates.
+
+        Returns
+        -------
+        Tuple[xr.DataArray, np.ndarray, np.ndarray]
+            The (lazy) power capacity factors restricted to the matched sub-grid with dims (time, latitude,
+            longitude), and the ERA5 latitude and longitude indices of that sub-grid.
+        """
+        lat_index = pd.Index(era5["latitude"].values).get_indexer(
+            power["latitude"].values
+        )
+        lon_index = pd.Index(era5["longitude"].values).get_indexer(
+            power["longitude"].values
+        )
+        lat_found, lon_found = lat_index >= 0, lon_index >= 0
+
+        power_grid = (
+            power["wofcfr"]
+            .isel(
+                latitude=np.flatnonzero(lat_found),
+                longitude=np.flatnonzero(lon_found),
+            )
+            .transpose("time", "latitude", "longitude")
+        )
+        return power_grid, lat_index[lat_found], lon_index[lon_found]
 
     @staticmethod
     def _merge_datasets(filepaths: List[str]) -> xr.Dataset:
@@ -280,3 +491,113 @@ class EnergyDataset(Dataset):
         power["longitude"] = power["longitude"] % 360
         power = power.sortby("longitude")
         return power
+
+
+def worker_init_fn(worker_id: int) -> None:
+    """
+    DataLoader worker_init_fn: reopens the datasets in each worker instead of using pickled xarray handles.
+
+    Parameters
+    ----------
+    worker_id : int
+        Id of the DataLoader worker (unused, the dataset copy is taken from the worker info).
+    """
+    worker_info = get_worker_info()
+    dataset = worker_info.dataset if worker_info is not None else None
+    if hasattr(dataset, "open"):
+        dataset.open()  # type: ignore
+
+
+def pack_energy_dataset(
+    filepath_era5: str,
+    filepath_power: str,
+    packed_path: str,
+    startDate: str,
+    endDate: str,
+    freq: str,
+    horizon: int = 24,
+) -> None:
+    """
+    Packs all timestamps required by an EnergyDataset into a PackedSampleStore (offline step).
+
+    The fields are written in their final model-ready layout, so that `EnergyDataset(..., packed_path=packed_path)`
+    only has to slice the memory maps. Use the same date range, frequency and horizon as for the dataset that
+    should read the store (or a range that covers it, e.g. train, val and test at once).
+
+    Parameters
+    ----------
+    filepath_era5 : str
+        Filepath to the ERA5 dataset (zarr).
+    filepath_power : str
+        Filepath to the power dataset (zarr).
+    packed_path : str
+        Output directory of the store.
+    startDate, endDate, freq : str
+        Date range and frequency of the samples, as passed to EnergyDataset.
+    horizon : int, optional
+        Forecast horizon in hours, by default 24.
+    """
+    dataset = EnergyDataset(
+        filepath_era5=filepath_era5,
+        filepath_power=filepath_power,
+        startDate=startDate,
+        endDate=endDate,
+        freq=freq,
+        horizon=horizon,
+    )
+
+    # Inputs and targets of all samples, every timestamp is stored only once
+    times = sorted(
+        {dataset.keys[i] for i in range(len(dataset))}
+        | {dataset.keys[i] + timedelta(hours=horizon) for i in range(len(dataset))}
+    )
+
+    os.makedirs(packed_path, exist_ok=True)
+    arrays = {
+        name: np.lib.format.open_memmap(
+            os.path.join(packed_path, f"{name}.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(times),) + shape,
+        )
+        for name, shape in PackedSampleStore.SHAPES.items()
+    }
+
+    for i, time in enumerate(times):
+        logger.info(f"Packing {time} ({i + 1}/{len(times)})")
+        upper, surface, power = dataset._load_fields(time)
+        arrays["upper"][i] = upper
+        arrays["surface"][i] = surface
+        arrays["power"][i] = power
+
+    for array in arrays.values():
+        array.flush()
+
+    # Times are written last, so an interrupted run does not leave a store that looks complete
+    np.save(
+        os.path.join(packed_path, "times.npy"),
+        np.array([time.strftime("%Y%m%d%H") for time in times]),
+    )
+
+
+if __name__ == "__main__":
+    # Run as module: python -m pangu_power.era5_data.energy_dataset --out <path>
+    parser = argparse.ArgumentParser(
+        description="Pack the energy dataset into a memory-mapped sample store"
+    )
+    parser.add_argument("--start", type=str, default=cfg.PG.TRAIN.START_TIME)
+    parser.add_argument("--end", type=str, default=cfg.PG.TEST.END_TIME)
+    parser.add_argument("--freq", type=str, default="6h")
+    parser.add_argument("--out", type=str, default=cfg.PACKED_DATA_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pack_energy_dataset(
+        cfg.ERA5_PATH,
+        cfg.POWER_PATH,
+        args.out,
+        args.start,
+        args.end,
+        args.freq,
+        cfg.PG.HORIZON,
+    )
@@ -521,8 +521,8 @@ def save_error_power(csv_path, power_scores, error):
 
 def prepare_europe(data: torch.Tensor) -> torch.Tensor:
     """Cut out Europe area from the data and replace land area with NaN."""
-    lsm = utils_data.loadLandSeaMask(
-        device=None, mask_type="sea", fill_value=float("nan")
+    lsm = utils_data.getLandSeaMask(
+        device=data.device, mask_type="sea", fill_value=float("nan")
     )
     # Cut out Europe area
     data = data * lsm
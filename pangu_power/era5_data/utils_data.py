@@ -5,69 +5,162 @@ from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import os
+import queue
+import threading
 from typing import Tuple
 import torch
 import random
 from torch.utils import data
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
 
 from ..era5_data.config import cfg
 
 
+def to_device(batch: Any, device: torch.device, non_blocking: bool = False) -> Any:
+    """Recursively moves all tensors in a (nested) batch to a device. Non-tensor entries (e.g. the timestamps) are returned untouched.
+
+    Parameters
+    ----------
+    batch : Any
+        Tensor, or list/tuple/dict containing tensors.
+    device : torch.device
+        The device to move the tensors to.
+    non_blocking : bool, optional
+        Whether to copy asynchronously (requires pinned memory), by default False.
+
+    Returns
+    -------
+    Any
+        The batch with the same structure, tensors on the device.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(b, device, non_blocking) for b in batch)
+    if isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+def _record_stream(batch: Any, stream: torch.cuda.Stream) -> None:
+    """Marks all tensors in a (nested) batch as used by a stream, so their memory is not reused while it is still in use."""
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for b in batch.values():
+            _record_stream(b, stream)
+
+
 class DataPrefetcher:
-    def __init__(self, loader):
+    """Iterates over a DataLoader and copies the next batch to the device while the current batch is processed.
+
+    On CUDA, the copies are issued on a side stream (use pin_memory in the DataLoader for truly asynchronous copies).
+    On other devices, the batches are loaded and moved by a background thread.
+
+    Parameters
+    ----------
+    loader : data.DataLoader
+        The DataLoader to iterate over.
+    device : torch.device
+        The device to move the batches to.
+    indices : Optional[Sequence[int]], optional
+        Positions of the batch entries to move to the device, by default None (all entries).
+        The remaining entries are passed through untouched, e.g. target fields that are only needed on the host.
+    queue_size : int, optional
+        Number of batches the background thread may load in advance (CPU only), by default 2.
+    """
+
+    def __init__(
+        self,
+        loader: data.DataLoader,
+        device: torch.device,
+        indices: Optional[Sequence[int]] = None,
+        queue_size: int = 2,
+    ):
         self.loader = loader
-        self.dataiter = iter(loader)
-        self.length = len(self.loader)
-        self.stream = torch.cuda.Stream()
-        # self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1,3,1,1)
-        # self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1,3,1,1)
-        # With Amp, it isn't necessary to manually convert data to half.
-        # if args.fp16:
-        #     self.mean = self.mean.half()
-        #     self.std = self.std.half()
-        self.__preload__()
-
-    def __preload__(self):
-        try:
-            (
-                self.input,
-                self.input_surface,
-                self.target,
-                self.target_surface,
-                self.periods,
-            ) = next(self.dataiter)
-        except StopIteration:
-            self.dataiter = iter(self.loader)
-            (
-                self.input,
-                self.input_surface,
-                self.target,
-                self.target_surface,
-                self.periods,
-            ) = next(self.dataiter)
-
-        with torch.cuda.stream(self.stream):  # type: ignore
-            self.target = self.target.cuda(non_blocking=True)
-            self.target_surface = self.target_surface.cuda(non_blocking=True)
-            self.input = self.input.cuda(non_blocking=True)
-            self.input_surface = self.input_surface.cuda(non_blocking=True)
-            self.periods = self.periods.cuda(non_blocking=True)
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        self.__preload__()
-        return (
-            self.input,
-            self.input_surface,
-            self.target,
-            self.target_surface,
-            self.periods,
+        self.device = torch.device(device)
+        self.indices = None if indices is None else set(indices)
+        self.queue_size = queue_size
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.device.type == "cuda":
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _to_device(self, batch: Any) -> Any:
+        if self.indices is None or not isinstance(batch, (list, tuple)):
+            return to_device(batch, self.device, non_blocking=True)
+        return type(batch)(
+            to_device(b, self.device, non_blocking=True) if i in self.indices else b
+            for i, b in enumerate(batch)
         )
 
-    def __len__(self):
-        """Return the number of images."""
-        return self.length
+    def _iter_cuda(self) -> Iterator[Any]:
+        stream = torch.cuda.Stream(device=self.device)
+        dataiter = iter(self.loader)
+
+        def preload() -> Any:
+            try:
+                batch = next(dataiter)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):  # type: ignore
+                return self._to_device(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+            # Issue the copy of the next batch before handing out the current one
+            next_batch = preload()
+            yield batch
+
+    def _iter_thread(self) -> Iterator[Any]:
+        batches: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer() -> None:
+            try:
+                for batch in self.loader:
+                    if not put(self._to_device(batch)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(done)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
 
 
 class NetCDFDataset(data.Dataset):
@@ -495,6 +588,212 @@ def loadLandSeaMask(
     return torch.tensor(lsm_expanded_np, device=device)
 
 
+class ConstantRegistry:
+    """Process-wide cache of constant tensors (masks, mean power, statistics).
+
+    Every constant is loaded once per (name, device, dtype, loader arguments) and the same tensor is handed out on
+    every later request. The tensors are shared, so they must not be modified in place.
+    """
+
+    def __init__(self) -> None:
+        self._constants: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(
+        name: str,
+        device: Optional[torch.device],
+        dtype: Optional[torch.dtype],
+        kwargs: Dict[str, Any],
+    ) -> tuple:
+        # repr makes the key hashable and comparable for NaN fill values
+        device = None if device is None else torch.device(device)
+        return (
+            name,
+            device,
+            dtype,
+            tuple(sorted((k, repr(v)) for k, v in kwargs.items())),
+        )
+
+    def get(
+        self,
+        name: str,
+        loader: Callable[..., Any],
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """Returns the cached constant, loading it with loader(device=device, **kwargs) on the first request.
+
+        Parameters
+        ----------
+        name : str
+            Name of the constant.
+        loader : Callable[..., Any]
+            Function loading the constant (a tensor or a dict of tensors).
+        device : Optional[torch.device], optional
+            Device of the constant, by default None (CPU).
+        dtype : Optional[torch.dtype], optional
+            Floating point dtype to convert the constant to, by default None (as loaded).
+        **kwargs : Any
+            Further arguments of the loader, part of the cache key.
+        """
+        key = self._key(name, device, dtype, kwargs)
+        with self._lock:
+            if key not in self._constants:
+                value = loader(device=device, **kwargs)
+                if dtype is not None:
+                    value = _to_dtype(value, dtype)
+                self._constants[key] = value
+            return self._constants[key]
+
+    def invalidate(
+        self, name: Optional[str] = None, device: Optional[torch.device] = None
+    ) -> None:
+        """Drops cached constants, e.g. after the files they were loaded from changed.
+
+        Parameters
+        ----------
+        name : Optional[str], optional
+            Only drop the constants with this name, by default None (all names).
+        device : Optional[torch.device], optional
+            Only drop the constants on this device, by default None (all devices).
+        """
+        device = None if device is None else torch.device(device)
+        with self._lock:
+            for key in list(self._constants):
+                if (name is None or key[0] == name) and (
+                    device is None or key[1] == device
+                ):
+                    del self._constants[key]
+
+
+def _to_dtype(value: Any, dtype: torch.dtype) -> Any:
+    if isinstance(value, torch.Tensor) and value.is_floating_point():
+        return value.to(dtype)
+    if isinstance(value, dict):
+        return {k: _to_dtype(v, dtype) for k, v in value.items()}
+    return value
+
+
+# Registry shared by the whole process
+constants = ConstantRegistry()
+
+
+def getLandSeaMask(
+    device: Optional[torch.device] = None,
+    mask_type: str = "sea",
+    fill_value: float = float("nan"),
+    dtype: Optional[torch.dtype] = None,
+) -> torch.Tensor:
+    """Cached loadLandSeaMask, see ConstantRegistry"""
+    return constants.get(
+        "land_sea_mask",
+        loadLandSeaMask,
+        device,
+        dtype,
+        mask_type=mask_type,
+        fill_value=fill_value,
+    )
+
+
+def getMeanPower(
+    device: Optional[torch.device] = None, dtype: Optional[torch.dtype] = None
+) -> torch.Tensor:
+    """Cached loadMeanPower, see ConstantRegistry"""
+    return constants.get("mean_power", loadMeanPower, device, dtype)
+
+
+def loadSeaIndices(
+    device: Optional[torch.device] = None, roi: bool = False
+) -> torch.Tensor:
+    """Flat indices (into the flattened [721, 1440] grid, or the ROI if roi is True) of the sea points of the land-sea mask"""
+    lsm = getLandSeaMask(device, mask_type="sea", fill_value=0)
+    if roi:
+        # All sea points must be inside the ROI, otherwise ROI mode would change the loss and scores
+        assert (
+            cropRoi(lsm).sum() == lsm.sum()
+        ), "The ROI (cfg.POWER.ROI_ROWS, cfg.POWER.ROI_COLS) does not contain all sea points"
+        lsm = cropRoi(lsm)
+    return torch.nonzero(lsm.flatten() == 1).squeeze(1)
+
+
+def getSeaIndices(
+    device: Optional[torch.device] = None, roi: bool = False
+) -> torch.Tensor:
+    """Cached loadSeaIndices, see ConstantRegistry"""
+    return constants.get("sea_indices", loadSeaIndices, device, roi=roi)
+
+
+def roiShape() -> Tuple[int, int]:
+    """Shape [H, W] of the region of interest (cfg.POWER.ROI_ROWS, cfg.POWER.ROI_COLS)"""
+    row_start, row_stop = cfg.POWER.ROI_ROWS
+    col_start, col_stop = cfg.POWER.ROI_COLS
+    return row_stop - row_start, col_stop - col_start
+
+
+def isRoi(x: torch.Tensor) -> bool:
+    """Whether a [..., H, W] field covers the region of interest instead of the [721, 1440] grid"""
+    return tuple(x.shape[-2:]) == roiShape()
+
+
+def roiIndex(
+    halo: int = 0, device: Optional[torch.device] = None
+) -> Tuple[slice, torch.Tensor]:
+    """Row slice and (circular) column indices of the region of interest, extended by halo points on each side.
+
+    The halo does not wrap around the poles, the ROI must be at least halo rows away from them.
+    """
+    row_start, row_stop = cfg.POWER.ROI_ROWS
+    col_start, col_stop = cfg.POWER.ROI_COLS
+    assert row_start - halo >= 0 and row_stop + halo <= 721, "ROI halo exceeds the grid"
+    rows = slice(row_start - halo, row_stop + halo)
+    cols = torch.arange(col_start - halo, col_stop + halo, device=device) % 1440
+    return rows, cols
+
+
+def cropRoi(x: torch.Tensor, halo: int = 0) -> torch.Tensor:
+    """Crops the region of interest (plus halo) out of [..., 721, 1440] fields, wrapping around the dateline"""
+    rows, cols = roiIndex(halo, x.device)
+    return x[..., rows, :].index_select(-1, cols)
+
+
+def scatterRoi(x: torch.Tensor, fill_value: float = 0.0) -> torch.Tensor:
+    """Places [..., H_roi, W_roi] fields onto the [..., 721, 1440] grid, the rest is filled with fill_value"""
+    rows, cols = roiIndex(device=x.device)
+    output = x.new_full((*x.shape[:-2], 721, 1440), fill_value)
+    output[..., rows, cols] = x
+    return output
+
+
+def toGlobalGrid(x: torch.Tensor) -> torch.Tensor:
+    """Returns fields on the [721, 1440] grid, scattering ROI outputs back (see scatterRoi)"""
+    return scatterRoi(x) if isRoi(x) else x
+
+
+def variableIndex(
+    variables: List[str], all_variables: List[str]
+) -> Union[slice, List[int]]:
+    """Channel index of a variable subset in fields of all_variables, a slice (i.e. a view) if the subset is
+    contiguous, slice(None) if it contains all variables"""
+    index = [all_variables.index(v) for v in variables]
+    if index == list(range(len(all_variables))):
+        return slice(None)
+    if index == list(range(index[0], index[-1] + 1)):
+        return slice(index[0], index[-1] + 1)
+    return index
+
+
+def gatherGridPoints(x: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """Gathers the grid points at flat indices from [..., 721, 1440] fields, returns [..., len(indices)]"""
+    return x.flatten(-2).index_select(-1, indices)
+
+
+def getAllConstants(device: Optional[torch.device] = None) -> Dict[str, torch.Tensor]:
+    """Cached loadAllConstants, see ConstantRegistry"""
+    return constants.get("all_constants", loadAllConstants, device)
+
+
 def loadWindPowerCurve(offshore: bool = True) -> pd.Series:
     """Load the wind power curves for onshore and offshore wind turbines.
 
@@ -514,6 +813,20 @@ def loadWindPowerCurve(offshore: bool = True) -> pd.Series:
     return power_curves["Power [kW] - Vestas Onshore V136-3450"]
 
 
+def loadWindPowerCurveCapacityFactor(offshore: bool = True) -> Dict[float, float]:
+    """Returns the power curve as {wind speed [m/s]: capacity factor}, like cfg.POWER_CURVE_OFFSHORE.
+
+    The offshore curve is cfg.POWER_CURVE_OFFSHORE, the onshore curve is loaded with loadWindPowerCurve and divided by
+    its rated (maximum) power.
+    """
+    if offshore:
+        return cfg.POWER_CURVE_OFFSHORE
+
+    power_curve = loadWindPowerCurve(offshore=False).dropna().sort_index()
+    capacity_factor = power_curve / power_curve.max()
+    return {float(k): float(v) for k, v in capacity_factor.items()}
+
+
 def normData(upper, surface, statistics):
     surface_mean, surface_std, upper_mean, upper_std = (
         statistics[0],
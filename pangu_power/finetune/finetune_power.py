@@ -1,10 +1,12 @@
 import os
+import time
 from argparse import Namespace
-from typing import List
+from typing import Any, Dict, List, Optional
 import torch
 from torch.optim.adam import Adam
 from torch.utils.data.distributed import DistributedSampler
 from torch.distributed import init_process_group, destroy_process_group
+import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch import nn
 from torch.utils import data
@@ -23,6 +25,8 @@ from ..models.pangu_power import (
     PanguPowerConv,
 )
 from ..models.pangu_model import PanguModel
+from ..models.layers import compile_blocks
+from ..models import feature_cache
 
 
 """
@@ -130,6 +134,9 @@ def load_model(device: torch.device) -> torch.nn.Module:
         if cfg.POWER.LORA:
             model = _setup_lora(model, req_grad_layers)
 
+    if cfg.PG.COMPILE:
+        compile_blocks(model)
+
     return model
 
 
@@ -155,6 +162,56 @@ def ddp_setup(
     init_process_group(backend="nccl", rank=rank, world_size=world_size)
 
 
+def _dataloader_kwargs(num_workers: int, pin_memory: bool) -> Dict[str, Any]:
+    """Returns the worker and memory related DataLoader arguments.
+
+    Parameters
+    ----------
+    num_workers : int
+        Number of worker processes, 0 loads on the main process.
+    pin_memory : bool
+        Whether to collate batches into page-locked memory.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Keyword arguments for data.DataLoader.
+    """
+    kwargs: Dict[str, Any] = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        # Datasets are reopened in each worker instead of being pickled
+        kwargs["worker_init_fn"] = energy_dataset.worker_init_fn
+        kwargs["prefetch_factor"] = cfg.PG.PREFETCH_FACTOR
+        kwargs["persistent_workers"] = cfg.PG.PERSISTENT_WORKERS
+    return kwargs
+
+
+def _create_dataset(
+    start: str,
+    end: str,
+    freq: str,
+    load_target_era5: bool,
+    load_input_era5: bool,
+    cache_key: Optional[str],
+) -> energy_dataset.EnergyDataset:
+    """Creates the energy dataset, or its cached-features variant if a cache key is given (see create_dataloader)."""
+    kwargs = dict(
+        filepath_era5=cfg.ERA5_PATH,
+        filepath_power=cfg.POWER_PATH,
+        startDate=start,
+        endDate=end,
+        freq=freq,
+        packed_path=cfg.PACKED_DATA_PATH or None,
+        load_target_era5=load_target_era5,
+        load_input_era5=load_input_era5,
+    )
+    if cache_key is not None:
+        return feature_cache.CachedFeatureDataset(
+            feature_cache.cache_path_for_model(cache_key), cache_key, **kwargs
+        )
+    return energy_dataset.EnergyDataset(**kwargs)
+
+
 def create_dataloader(
     start: str,
     end: str,
@@ -162,6 +219,11 @@ def create_dataloader(
     batch_size: int,
     shuffle: bool,
     distributed: bool = False,
+    num_workers: Optional[int] = None,
+    pin_memory: Optional[bool] = None,
+    load_target_era5: bool = True,
+    load_input_era5: bool = True,
+    cache_key: Optional[str] = None,
 ) -> data.DataLoader:
     """Creates a DataLoader for the energy dataset. If distributed is set to True, the DataLoader will be created with a DistributedSampler.
 
@@ -179,18 +241,29 @@ def create_dataloader(
         Whether to shuffle the data
     distributed : bool, optional
         Whether to use a DistributedSampler, by default False
+    num_workers : Optional[int], optional
+        Number of DataLoader workers, by default cfg.PG.NUM_WORKERS
+    pin_memory : Optional[bool], optional
+        Whether to use pinned memory, by default cfg.PG.PIN_MEMORY
+    load_target_era5 : bool, optional
+        Whether samples contain the target ERA5 fields, by default True
+    load_input_era5 : bool, optional
+        Whether samples contain the input ERA5 fields, by default True
+    cache_key : Optional[str], optional
+        Key of the feature cache (see feature_cache.cache_key). If given, samples contain the cached features of the
+        frozen model part instead of the inputs, by default None
 
     Returns
     -------
     data.DataLoader
         The DataLoader for the energy dataset
     """
-    dataset = energy_dataset.EnergyDataset(
-        filepath_era5=cfg.ERA5_PATH,
-        filepath_power=cfg.POWER_PATH,
-        startDate=start,
-        endDate=end,
-        freq=freq,
+    dataset = _create_dataset(
+        start, end, freq, load_target_era5, load_input_era5, cache_key
+    )
+    loader_kwargs = _dataloader_kwargs(
+        cfg.PG.NUM_WORKERS if num_workers is None else num_workers,
+        cfg.PG.PIN_MEMORY if pin_memory is None else pin_memory,
     )
     if not distributed:
         return data.DataLoader(
@@ -198,19 +271,157 @@ def create_dataloader(
             batch_size=batch_size,
             drop_last=True,
             shuffle=shuffle,
-            num_workers=0,
-            pin_memory=False,
+            **loader_kwargs,
         )
     train_sampler = DistributedSampler(dataset, shuffle=True, drop_last=True)
     return data.DataLoader(
         dataset=dataset,
         batch_size=batch_size,
-        num_workers=0,
-        pin_memory=False,
         sampler=train_sampler,
+        **loader_kwargs,
     )
 
 
+def benchmark_dataloader(
+    loader: data.DataLoader, device: torch.device, num_batches: int = 20
+) -> float:
+    """Measures the throughput of a DataLoader, including the host-to-device copy of the model inputs.
+
+    Parameters
+    ----------
+    loader : data.DataLoader
+        The DataLoader to benchmark.
+    device : torch.device
+        Device the inputs are copied to.
+    num_batches : int, optional
+        Number of batches to load (the first batch is excluded as warm-up), by default 20.
+
+    Returns
+    -------
+    float
+        Samples per second.
+    """
+    num_samples = 0
+    start_time = time.perf_counter()
+    for id, batch in enumerate(loader):
+        if id == 0:
+            # Exclude worker startup
+            start_time = time.perf_counter()
+            continue
+        input, input_surface, _, target_power, _, _, _ = batch
+        for tensor in (input, input_surface, target_power):
+            tensor.to(device, non_blocking=True)
+        num_samples += input.shape[0]
+        if id == num_batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return num_samples / (time.perf_counter() - start_time)
+
+
+def compare_dataloaders(args: argparse.Namespace, num_batches: int = 20) -> None:
+    """Compares the throughput of the single-process loader with the configured (multi-worker) loader.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command-line arguments, used for the device and the logger.
+    num_batches : int, optional
+        Number of batches to load per loader, by default 20.
+    """
+    output_path = os.path.join(cfg.PG_OUT_PATH, args.type_net, str(cfg.PG.HORIZON))
+    utils.mkdirs(output_path)
+    logger = setup_logger(args.type_net, cfg.PG.HORIZON, output_path)
+    device = _get_device(0, args.gpu_list)
+
+    settings = {
+        "main process (num_workers=0, pin_memory=False)": (0, False),
+        f"configured (num_workers={cfg.PG.NUM_WORKERS}, pin_memory={cfg.PG.PIN_MEMORY})": (
+            cfg.PG.NUM_WORKERS,
+            cfg.PG.PIN_MEMORY,
+        ),
+    }
+    for name, (num_workers, pin_memory) in settings.items():
+        loader = create_dataloader(
+            cfg.PG.TRAIN.START_TIME,
+            cfg.PG.TRAIN.END_TIME,
+            cfg.PG.TRAIN.FREQUENCY,
+            cfg.PG.TRAIN.BATCH_SIZE,
+            True,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            load_target_era5=cfg.PG.TRAIN.LOAD_TARGET_ERA5,
+        )
+        throughput = benchmark_dataloader(loader, device, num_batches)
+        logger.info(f"DataLoader {name}: {throughput:.3f} samples/s")
+
+
+def prepare_feature_cache(
+    model: torch.nn.Module,
+    device: torch.device,
+    rank: int,
+    world_size: int,
+    logger: logging.Logger,
+) -> str:
+    """Caches the outputs of the frozen model part for the training and validation datasets (see feature_cache).
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The (unwrapped) model, as returned by load_model.
+    device : torch.device
+        Device to run the model on.
+    rank : int
+        The rank of the current process, samples are split between the ranks.
+    world_size : int
+        Total number of processes.
+    logger : logging.Logger
+        Logger for the progress of the caching.
+
+    Returns
+    -------
+    str
+        Key of the cache (see feature_cache.cache_key).
+    """
+    # Only models which train nothing but their head can use the cache
+    if cfg.POWER.MODEL_TYPE not in [
+        "PanguPowerPatchRecovery",
+        "PanguPowerConv",
+        "PanguPowerConvSigmoid",
+    ]:
+        raise ValueError(
+            f"Feature cache is not supported for model type: {cfg.POWER.MODEL_TYPE}"
+        )
+    if cfg.POWER.LORA:
+        raise ValueError("Feature cache can not be used with LoRA")
+
+    # Features are stored per frozen weights and configuration, stale features are never reused
+    key = feature_cache.cache_key(model, device)
+    if rank == 0:
+        logger.info(f"Feature cache: {feature_cache.cache_path_for_model(key)}")
+
+    for split in [cfg.PG.TRAIN, cfg.PG.VAL]:
+        dataset = _create_dataset(
+            split.START_TIME, split.END_TIME, split.FREQUENCY, False, True, None
+        )
+        feature_cache.cache_features(
+            model,
+            dataset,
+            feature_cache.cache_path_for_model(key),
+            key,
+            device,
+            logger,
+            rank,
+            world_size,
+        )
+
+    # Wait until all ranks have written their part of the cache
+    if dist.is_initialized():
+        dist.barrier()
+
+    return key
+
+
 def set_requires_grad(model: torch.nn.Module, layer_name: str) -> None:
     """Sets the `requires_grad` attribute of the parameters in the model.
     This function will first set `requires_grad` to False for all parameters in the model.
@@ -358,6 +569,13 @@ def main(
     if rank == 0:
         logger.info(f"Start finetuning {args.type_net} on energy dataset")
 
+    model = load_model(device)
+
+    # Run the frozen model part once per timestamp, training then only runs the head
+    cache_key = None
+    if cfg.PG.FEATURE_CACHE.ENABLED:
+        cache_key = prepare_feature_cache(model, device, rank, world_size, logger)
+
     train_dataloader = create_dataloader(
         cfg.PG.TRAIN.START_TIME,
         cfg.PG.TRAIN.END_TIME,
@@ -365,6 +583,8 @@ def main(
         cfg.PG.TRAIN.BATCH_SIZE,
         True,
         args.dist,
+        load_target_era5=cfg.PG.TRAIN.LOAD_TARGET_ERA5,
+        cache_key=cache_key,
     )
     val_dataloader = create_dataloader(
         cfg.PG.VAL.START_TIME,
@@ -372,9 +592,10 @@ def main(
         cfg.PG.VAL.FREQUENCY,
         cfg.PG.VAL.BATCH_SIZE,
         False,
+        load_target_era5=cfg.PG.VAL.LOAD_TARGET_ERA5,
+        cache_key=cache_key,
     )
 
-    model = load_model(device)
     model = DDP(model, device_ids=[device])
 
     # If static graph is not set, LoRA returns errors.
@@ -449,14 +670,13 @@ def test_best_model(args: argparse.Namespace) -> None:
         weights_only=False,
     ).to(device)
 
-    set_model_device_recursively(best_model, device)
-
     test_dataloader = create_dataloader(
         cfg.PG.TEST.START_TIME,
         cfg.PG.TEST.END_TIME,
         cfg.PG.TEST.FREQUENCY,
         cfg.PG.TEST.BATCH_SIZE,
         False,
+        load_target_era5=cfg.PG.TEST.LOAD_TARGET_ERA5 and cfg.PG.TEST.VISUALIZE,
     )
 
     test(
@@ -468,20 +688,6 @@ def test_best_model(args: argparse.Namespace) -> None:
     )
 
 
-def set_model_device_recursively(module: nn.Module, device: torch.device) -> None:
-    """Recursively sets the `device` attribute for the given module and all its children. This is required becuase some masks are generated dynamically during model inference using the self.device parameter of that layers, which is set initially during model instantiation. If e.g., training and testing happens on different, the masks will be generated on the wrong device (if not set correctly by this function) which will cause an error.
-
-    Args:
-        module (nn.Module): The root module whose `device` attribute and its children's will be updated.
-        device (torch.device): The target device to set.
-    """
-    if hasattr(module, "device"):
-        module.device = device  # type: ignore
-
-    for child in module.children():
-        set_model_device_recursively(child, device)
-
-
 def test_baselines(args: Namespace, baseline_type: str) -> None:
     """Test the performance of baseline models.
 
@@ -502,18 +708,27 @@ def test_baselines(args: Namespace, baseline_type: str) -> None:
     logger.info("Begin testing...")
     device = _get_device(0, args.gpu_list)
 
+    # Pangu is only needed for the formula baseline, unless its stored forecasts are used. Without pangu only the
+    # power fields are loaded, the ERA5 fields of the visualized steps are loaded on demand
+    run_pangu = baseline_type == "formula" and not cfg.PG.TEST.STORED_PANGU_OUTPUTS
     test_dataloader = create_dataloader(
         cfg.PG.TEST.START_TIME,
         cfg.PG.TEST.END_TIME,
         cfg.PG.TEST.FREQUENCY,
         cfg.PG.TEST.BATCH_SIZE,
         False,
+        load_target_era5=run_pangu
+        and cfg.PG.TEST.LOAD_TARGET_ERA5
+        and cfg.PG.TEST.VISUALIZE,
+        load_input_era5=run_pangu,
     )
 
-    pangu_model = PanguModel(device=device).to(device)
+    pangu_model = None
+    if run_pangu:
+        pangu_model = PanguModel(device=device).to(device)
 
-    checkpoint = torch.load(cfg.PG.BENCHMARK.PRETRAIN_24_torch, weights_only=False)
-    pangu_model.load_state_dict(checkpoint["model"])
+        checkpoint = torch.load(cfg.PG.BENCHMARK.PRETRAIN_24_torch, weights_only=False)
+        pangu_model.load_state_dict(checkpoint["model"])
 
     test_baseline(
         test_loader=test_dataloader,
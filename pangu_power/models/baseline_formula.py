@@ -1,15 +1,40 @@
+from typing import Dict, List, Optional
+import numpy as np
 from torch import Tensor
 import torch
 from torch import nn
+from ..era5_data import utils_data
 from ..era5_data.config import cfg
 
 
 class BaselineFormula(nn.Module):
     """Baseline model that uses wind turbine power curve to predict power"""
 
-    def __init__(self, device: torch.device):
+    def __init__(
+        self,
+        device: torch.device,
+        power_curve: Optional[Dict[float, float]] = None,
+        use_lut: bool = cfg.POWER.CURVE_LUT,
+    ):
+        """
+        Parameters
+        ----------
+        device : torch.device
+            Device of the power curve tensors
+        power_curve : Optional[Dict[float, float]], optional
+            Power curve {wind speed [m/s]: capacity factor}, by default the curve selected by cfg.POWER.OFFSHORE_CURVE
+            (see utils_data.loadWindPowerCurveCapacityFactor)
+        use_lut : bool, optional
+            Whether to evaluate the power curve with the uniform grid lookup table (see _lut_capacity_factor) instead
+            of searchsorted, by default cfg.POWER.CURVE_LUT
+        """
         super().__init__()
-        self.offshore_power_curve_fapacity_factor = cfg.POWER_CURVE_OFFSHORE
+        if power_curve is None:
+            power_curve = utils_data.loadWindPowerCurveCapacityFactor(
+                cfg.POWER.OFFSHORE_CURVE
+            )
+        self.offshore_power_curve_fapacity_factor = power_curve
+        self.use_lut = use_lut
 
         # Check if keys are sorted, required for linear search in interpolation
         assert list(self.offshore_power_curve_fapacity_factor.keys()) == sorted(
@@ -27,6 +52,13 @@ class BaselineFormula(nn.Module):
             dtype=torch.float32,
             device=device,
         )
+        self._build_lut(device)
+
+        # Channels of the wind components in the pangu outputs
+        self.upper_u = cfg.ERA5_UPPER_VARIABLES.index("u")
+        self.upper_v = cfg.ERA5_UPPER_VARIABLES.index("v")
+        self.surface_u = cfg.ERA5_SURFACE_VARIABLES.index("u10")
+        self.surface_v = cfg.ERA5_SURFACE_VARIABLES.index("v10")
 
     def forward(
         self,
@@ -57,21 +89,159 @@ class BaselineFormula(nn.Module):
         if use_surface:
             # Calculate wind speed from surface u and v components (surface level). ws = (u^2 + v^2)^0.5
             wind_speed = torch.sqrt(
-                pangu_output_surface[:, 1, :, :] ** 2
-                + pangu_output_surface[:, 2, :, :] ** 2
+                pangu_output_surface[:, self.surface_u, :, :] ** 2
+                + pangu_output_surface[:, self.surface_v, :, :] ** 2
             )
         else:
             # Calculate wind speed from upper u and v components (surface level). ws = (u^2 + v^2)^0.5
             wind_speed = torch.sqrt(
-                pangu_output_upper[:, 3, z, :, :] ** 2
-                + pangu_output_upper[:, 4, z, :, :] ** 2
+                pangu_output_upper[:, self.upper_u, z, :, :] ** 2
+                + pangu_output_upper[:, self.upper_v, z, :, :] ** 2
             )
 
         # Calculate wind power
-        output_power = self._interpolate_wind_capacity_factor(wind_speed)
+        output_power = self._capacity_factor(wind_speed)
 
         return output_power
 
+    def forward_all(
+        self,
+        pangu_output_upper: Tensor,
+        pangu_output_surface: Tensor,
+        hub_heights: List[float] = cfg.POWER.HUB_HEIGHTS,
+    ) -> Tensor:
+        """Calculates the power output of all pressure levels, the surface and the hub heights in one interpolation
+        (searchsorted) pass over a batch.
+
+        Parameters
+        ----------
+        pangu_output_upper : Tensor
+            Pangu output tensor for upper level, [B, 5, 13, H, W]
+        pangu_output_surface : Tensor
+            Pangu output tensor for surface level, [B, 4, H, W]
+        hub_heights : List[float], optional
+            Hub heights [m] the surface (10 m) wind speed is extrapolated to with the power law (exponent
+            cfg.POWER.WIND_SHEAR_EXPONENT), by default cfg.POWER.HUB_HEIGHTS
+
+        Returns
+        -------
+        Tensor
+            Calculated power output tensor, [B, 13 + 1 + len(hub_heights), H, W]: the pressure levels (in the order of
+            pangu_output_upper, 1000hPa first), the surface and the hub heights (see level_names)
+        """
+        # Wind speeds of all levels, ws = (u^2 + v^2)^0.5
+        wind_speed_upper = torch.hypot(
+            pangu_output_upper[:, self.upper_u], pangu_output_upper[:, self.upper_v]
+        )  # [B, 13, H, W]
+        wind_speed_surface = torch.hypot(
+            pangu_output_surface[:, self.surface_u : self.surface_u + 1],
+            pangu_output_surface[:, self.surface_v : self.surface_v + 1],
+        )  # [B, 1, H, W]
+
+        # Power law extrapolation of the 10 m wind speed to the hub heights
+        shear = torch.tensor(hub_heights, device=wind_speed_surface.device) / 10.0
+        shear = shear**cfg.POWER.WIND_SHEAR_EXPONENT
+        wind_speed_hub = wind_speed_surface * shear.view(1, -1, 1, 1).to(
+            wind_speed_surface.dtype
+        )  # [B, len(hub_heights), H, W]
+
+        wind_speed = torch.cat(
+            (wind_speed_upper, wind_speed_surface, wind_speed_hub), dim=1
+        )
+        return self._capacity_factor(wind_speed)
+
+    def level_names(
+        self, hub_heights: List[float] = cfg.POWER.HUB_HEIGHTS
+    ) -> List[str]:
+        """Names of the output channels of forward_all, e.g. "1000hPa", "surface" and "hub_100m"."""
+        return (
+            [f"{level}hPa" for level in cfg.ERA5_UPPER_LEVELS]
+            + ["surface"]
+            + [f"hub_{height}m" for height in hub_heights]
+        )
+
+    def _build_lut(
+        self, device: torch.device, step: float = cfg.POWER.CURVE_LUT_STEP
+    ) -> None:
+        """Samples the power curve (in float64) on a uniform wind speed grid for _lut_capacity_factor.
+
+        A discontinuity of the curve (consecutive knots that are equal in float32, the cut-out of the offshore curve
+        at 25 m/s) ends the grid: wind speeds from it on get the constant power of the curve behind it, like with
+        searchsorted on the float32 knots. Without a discontinuity, wind speeds are clamped to the range of the curve
+        like in _interpolate_wind_capacity_factor.
+        """
+        curve = self.offshore_power_curve_fapacity_factor
+        speeds = np.array(list(curve.keys()), dtype=np.float64)
+        powers = np.array(list(curve.values()), dtype=np.float64)
+
+        jumps = np.flatnonzero(np.diff(speeds.astype(np.float32)) == 0)
+        if len(jumps) > 0:
+            cut_out = jumps[0]
+            assert np.all(
+                powers[cut_out + 1 :] == powers[cut_out + 1]
+            ), "The power curve must be constant behind its discontinuity"
+            self.lut_max_speed = float(speeds[cut_out])
+            self.lut_cut_out_power = float(powers[cut_out + 1])
+        else:
+            self.lut_max_speed = float(speeds[-1])
+            self.lut_cut_out_power = None
+
+        # Intervals [min_speed + i * step, min_speed + (i + 1) * step], the last one may be shorter
+        self.lut_min_speed = float(speeds[0])
+        n = int(np.ceil((self.lut_max_speed - self.lut_min_speed) / step - 1e-9))
+        n = max(n, 1)
+        grid = np.minimum(
+            self.lut_min_speed + step * np.arange(n + 1), self.lut_max_speed
+        )
+        # Knots up to the discontinuity, the grid never reaches the knots behind it
+        end = jumps[0] + 1 if len(jumps) > 0 else len(speeds)
+        grid_power = np.interp(grid, speeds[:end], powers[:end])
+        slope = np.diff(grid_power) / np.diff(grid) * step
+        self.lut_inv_step = 1.0 / step
+
+        # Rows (power at the interval start, power increase per step), gathered together in one index_select
+        self.lut = torch.tensor(
+            np.stack((grid_power[:-1], slope), axis=-1),
+            dtype=torch.float32,
+            device=device,
+        )  # [n, 2]
+
+    def _capacity_factor(self, wind_speed: torch.Tensor) -> torch.Tensor:
+        """Capacity factor of the wind speeds, with the lookup table or with searchsorted (see use_lut)."""
+        if self.use_lut:
+            return self._lut_capacity_factor(wind_speed)
+        return self._interpolate_wind_capacity_factor(wind_speed)
+
+    def _lut_capacity_factor(self, wind_speed: torch.Tensor) -> torch.Tensor:
+        """Interpolates the capacity factor with the uniform grid lookup table of _build_lut.
+
+        Parameters
+        ----------
+        wind_speed : torch.Tensor
+            A tensor containing wind speeds.
+
+        Returns
+        -------
+        torch.Tensor
+            A tensor containing interpolated capacity factors.
+        """
+        # Position on the grid, in steps
+        t = (
+            wind_speed.clamp(self.lut_min_speed, self.lut_max_speed)
+            - self.lut_min_speed
+        ) * self.lut_inv_step
+        index = t.floor().clamp_(max=len(self.lut) - 1)
+        rows = self.lut.index_select(0, index.long().flatten()).view(*t.shape, 2)
+
+        # Linear interpolation, the slopes are per step
+        output = torch.addcmul(rows[..., 0], rows[..., 1], t - index)
+
+        if self.lut_cut_out_power is not None:
+            output = output.masked_fill(
+                wind_speed >= self.lut_max_speed, self.lut_cut_out_power
+            )
+        return output
+
     # Interpolation function
     def _interpolate_wind_capacity_factor(
         self, wind_speed: torch.Tensor
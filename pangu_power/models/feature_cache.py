@@ -0,0 +1,174 @@
+# Caches the outputs of the frozen part of the power models, so that finetuning only runs the trainable head.
+
+import os
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Tuple
+import numpy as np
+import torch
+from torch import nn
+
+from ..era5_data import utils_data
+from ..era5_data.energy_dataset import EnergyDataset
+from ..era5_data.config import cfg
+
+
+def feature_path(cache_path: str, time: str) -> str:
+    """Returns the file of the cached features of an input time ("%Y%m%d%H")."""
+    return os.path.join(cache_path, f"features_{time}.pth")
+
+
+def cache_key(model: nn.Module, device: torch.device) -> str:
+    """
+    Returns a hash of everything the cached features depend on: the frozen weights (parameters and buffers of the
+    modules of model._stage_order()), the constants of the input normalization and the configuration of the data
+    and the head. Features are stored per key (see cache_path_for_model) and checked against it when loaded.
+    """
+    digest = hashlib.sha256()
+    config = (
+        cfg.POWER.MODEL_TYPE,
+        cfg.ERA5_PATH,
+        cfg.PACKED_DATA_PATH,
+        cfg.POWERCONV.UPPER_VARIABLES,
+        cfg.POWERCONV.SURFACE_VARIABLES,
+    )
+    digest.update(repr(config).encode())
+
+    tensors = []
+    for stage in model._stage_order():
+        tensors += list(stage.named_parameters()) + list(stage.named_buffers())
+    aux_constants = utils_data.getAllConstants(device=device)
+    tensors += [(name, aux_constants[name]) for name in sorted(aux_constants)]
+    for name, tensor in tensors:
+        digest.update(name.encode())
+        tensor = tensor.detach().cpu().contiguous().view(-1)
+        digest.update(tensor.view(torch.uint8).numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def cache_features(
+    model: nn.Module,
+    dataset: EnergyDataset,
+    cache_path: str,
+    key: str,
+    device: torch.device,
+    logger: logging.Logger,
+    rank: int = 0,
+    world_size: int = 1,
+) -> None:
+    """
+    Runs the frozen part of the model (model.forward_frozen) once per input time and stores the outputs the head
+    uses (model.head_features) in fp16, together with the cache key.
+
+    Features that already exist are skipped. In distributed mode, the samples are split between the ranks.
+    The cache is only valid for the frozen weights and configuration of its key (see cache_key).
+
+    Parameters
+    ----------
+    model : nn.Module
+        The (unwrapped) power model, must implement forward_frozen.
+    dataset : EnergyDataset
+        The dataset whose inputs are cached.
+    cache_path : str
+        Directory of the cache.
+    key : str
+        Key of the frozen weights and configuration (see cache_key), stored with the features.
+    device : torch.device
+        Device to run the model on.
+    logger : logging.Logger
+        Logger for the progress of the caching.
+    rank : int, optional
+        Rank of the current process, by default 0.
+    world_size : int, optional
+        Number of processes, by default 1.
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    aux_constants = utils_data.getAllConstants(device=device)
+
+    # Frozen layers are evaluated deterministically (no dropout/drop path)
+    was_training = model.training
+    model.eval()
+
+    for index in range(rank, len(dataset), world_size):
+        time = dataset.keys[index].strftime("%Y%m%d%H")
+        path = feature_path(cache_path, time)
+        if os.path.exists(path):
+            continue
+
+        logger.info(f"Caching features of {time} ({index + 1}/{len(dataset)})")
+        upper, surface, _ = dataset._load_fields(dataset.keys[index])
+        features = model.forward_frozen(
+            torch.from_numpy(upper).unsqueeze(0).to(device),
+            torch.from_numpy(surface).unsqueeze(0).to(device),
+            aux_constants["weather_statistics"],
+            aux_constants["constant_maps"],
+            aux_constants["const_h"],
+        )
+        features = tuple(
+            f.squeeze(0).half().cpu() for f in model.head_features(*features)
+        )
+
+        # Written to a temporary file first, so interrupted runs do not leave incomplete features
+        torch.save({"key": key, "features": features}, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    model.train(was_training)
+
+
+class CachedFeatureDataset(EnergyDataset):
+    """
+    EnergyDataset that returns the cached outputs of the frozen model part (see cache_features) instead of the
+    input ERA5 fields.
+
+    Samples keep the layout of EnergyDataset: the first entry is a tuple of fp16 feature tensors, the input surface
+    and the target ERA5 fields are empty arrays (they can be loaded with load_era5 for visualization).
+    """
+
+    def __init__(self, cache_path: str, key: str, *args, **kwargs) -> None:
+        """
+        Parameters
+        ----------
+        cache_path : str
+            Directory of the cache, as written by cache_features.
+        key : str
+            Key of the current frozen weights and configuration (see cache_key), features with another key are
+            rejected.
+        *args, **kwargs
+            Passed to EnergyDataset.
+        """
+        kwargs["load_target_era5"] = False
+        super().__init__(*args, **kwargs)
+        self.cache_path = cache_path
+        self.key = key
+
+    def _load_data(self, key: datetime) -> Tuple:
+        start_time_str = key.strftime("%Y%m%d%H")
+        end_time = key + timedelta(hours=self.horizon)
+        end_time_str = end_time.strftime("%Y%m%d%H")
+
+        cached = torch.load(feature_path(self.cache_path, start_time_str))
+        assert (
+            cached["key"] == self.key
+        ), f"Cached features of {start_time_str} belong to other frozen weights or configuration"
+        features = cached["features"]
+        input_power = self._load_power_field(key)
+        target_power = self._load_power_field(end_time)
+        empty = np.empty((0,), dtype=np.float32)
+
+        return (
+            features,
+            empty,
+            input_power,
+            target_power,
+            empty,
+            empty,
+            (start_time_str, end_time_str),
+        )
+
+
+def cache_path_for_model(key: str) -> str:
+    """Returns the cache directory of the configured model type and a cache key (see cache_key)."""
+    return os.path.join(cfg.PG.FEATURE_CACHE.PATH, cfg.POWER.MODEL_TYPE, key[:16])
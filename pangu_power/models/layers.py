@@ -4,10 +4,13 @@ from torch import nn
 import torch
 import torch.utils.checkpoint as checkpoint
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from timm.models.layers import DropPath, trunc_normal_
 from collections import OrderedDict
+import functools
 
 from ..era5_data.config import cfg
+from ..era5_data import utils_data
 
 
 class PatchEmbedding_pretrain(nn.Module):
@@ -24,6 +27,9 @@ class PatchEmbedding_pretrain(nn.Module):
         self.window_size = (2, 6, 12)  # Z,H,W
         # self.Pad2D = nn.ConstantPad2d((0, 0, 0, 3), 0)
         # self.Pad3D = nn.ConstantPad3d((0, 0, 0, 3, 0, 1),0)
+        self.fold_normalization = cfg.PG.FOLD_PATCH_EMBEDDING
+        # (key, surface weight, upper weight, bias), see _folded_parameters
+        self._folded = None
 
     def check_image_size_2d(self, x):
         _, _, h, w = x.size()
@@ -53,16 +59,114 @@ class PatchEmbedding_pretrain(nn.Module):
         return x
 
     def forward(self, input, input_surface, statistics, maps, const_h):
-        # input:(B, N, Z, H, W) input_surface(B,N,H,W)
-        # Zero-pad the input
-        self.surface_mean, self.surface_std, self.upper_mean, self.upper_std = (
-            statistics[0],
-            statistics[1],
-            statistics[2],
-            statistics[3],
+        # The folded path has no gradients for the embedding weights
+        if self.fold_normalization and not (
+            torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())
+        ):
+            return self.forward_folded(input, input_surface, statistics, maps, const_h)
+        return self.forward_reference(input, input_surface, statistics, maps, const_h)
+
+    def forward_folded(self, input, input_surface, statistics, maps, const_h):
+        """Same result as forward_reference with one patchify and one matmul per input.
+        The embedding is affine in the inputs: the normalization scales are folded into the conv weights, everything
+        else (normalization offsets, constant masks, const_h, conv biases and the zero-padding) is a precomputed
+        bias. Runs in fp32 (also under autocast), since the raw inputs are not normalized before the matmul.
+        """
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            surface_weight, upper_weight, bias = self._folded_parameters(
+                input, input_surface, statistics, maps, const_h
+            )
+            # Number of patches, (721 + 3) // 4 = 181 and 1440 // 4 = 360
+            B, H, W = input.shape[0], (input.shape[-2] + 3) // 4, input.shape[-1] // 4
+
+            # Surface patches, [1, 4, 721, 1440] -> [1, 65160, 64] (channels ordered as in the conv: variable, pixel)
+            input_surface = F.pad(input_surface.float(), (0, 0, 0, 3), "constant")
+            input_surface = input_surface.view(B, 4, H, 4, W, 4)
+            input_surface = torch.permute(input_surface, (0, 2, 4, 1, 3, 5))
+            input_surface = input_surface.reshape(B, H * W, 64)
+            input_surface = F.linear(input_surface, surface_weight)  # [1, 65160, 192]
+
+            # Upper-air patches, [1, 5, 13, 721, 1440] -> [1, 7, 65160, 160], per level patch
+            input = F.pad(input.float(), (0, 0, 0, 3, 0, 1), "constant")
+            input = input.view(B, 5, 7, 2, H, 4, W, 4)
+            input = torch.permute(input, (0, 2, 4, 6, 1, 3, 5, 7))
+            input = input.reshape(B, 7, H * W, 160)
+            # [1, 7, 65160, 192]
+            input = torch.matmul(input, upper_weight.transpose(1, 2))
+
+            x = torch.cat((input_surface.unsqueeze(1), input), dim=1)
+            x = x.view(B, 8 * H * W, x.shape[-1])  # ([1, 521280, 192]) [B, spatial, C]
+            return x.add_(bias)
+
+    def _folded_parameters(self, input, input_surface, statistics, maps, const_h):
+        """Returns the folded surface weight [192, 64], upper weight [7, 192, 160] and bias [1, 521280, 192].
+        Computed once and reused until the weights, statistics or constants change."""
+        key = (
+            tuple((p._version, p.data_ptr(), p.dtype) for p in self.parameters()),
+            tuple(s.data_ptr() for s in statistics),
+            maps.data_ptr(),
+            const_h.data_ptr(),
         )
-        self.constant_masks = maps
-
+        if self._folded is not None and self._folded[0] == key:
+            return self._folded[1:]
+
+        with torch.no_grad():
+            # Constant part: the embedding of all-zero inputs
+            zeros_upper = input.new_zeros((1, *input.shape[1:]), dtype=torch.float32)
+            zeros_surface = input_surface.new_zeros(
+                (1, *input_surface.shape[1:]), dtype=torch.float32
+            )
+            bias = self.forward_reference(
+                zeros_upper, zeros_surface, statistics, maps, const_h
+            ).contiguous()
+
+            # Scales of the normalization, [4] and [5, 13]. Probed with a large power of two, a probe of 1 would
+            # lose the precision of the scale to the cancellation of the means (e.g. 1 - mean, with |mean| >> 1)
+            probe = torch.stack([zeros_surface[:, :, :1, :1]] * 2)
+            probe[1] = 2**24
+            surface_scale = self._normalize_surface(probe[1], statistics) - (
+                self._normalize_surface(probe[0], statistics)
+            )
+            surface_scale = surface_scale.view(4) / 2**24
+            probe = torch.stack([zeros_upper[:, :, :, :1, :1]] * 2)
+            probe[1] = 2**24
+            upper_scale = self._normalize_upper(probe[1], statistics) - (
+                self._normalize_upper(probe[0], statistics)
+            )
+            upper_scale = upper_scale.view(5, 13) / 2**24
+
+            # Conv input channels are (variable, pixel) for the surface and (variable, level in patch, pixel) for
+            # the upper-air, the constant channels (masks, const_h) are not needed
+            dim = self.conv.out_channels
+            surface_weight = self.conv_surface.weight.float().view(dim, 7, 16)[:, :4]
+            surface_weight = surface_weight * surface_scale.view(1, 4, 1)
+            surface_weight = surface_weight.reshape(dim, 64)
+
+            # The scales depend on the level of the patch, the padded level has no scale (its input is zero)
+            upper_scale = F.pad(upper_scale, (0, 1)).view(5, 7, 2)
+            upper_scale = torch.permute(upper_scale, (1, 0, 2))  # [7, 5, 2]
+            upper_weight = self.conv.weight.float().view(dim, 6, 2, 16)[:, :5]
+            upper_weight = upper_weight.unsqueeze(0) * upper_scale.view(7, 1, 5, 2, 1)
+            upper_weight = upper_weight.reshape(7, dim, 160)
+
+        self._folded = (key, surface_weight, upper_weight, bias)
+        return self._folded[1:]
+
+    def __getstate__(self):
+        # The folded parameters are not copied or pickled (e.g. with the best model)
+        state = self.__dict__.copy()
+        state["_folded"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Modules pickled before the folded embedding existed (e.g. an older best_model.pth)
+        state.setdefault("fold_normalization", cfg.PG.FOLD_PATCH_EMBEDDING)
+        state.setdefault("_folded", None)
+        super().__setstate__(state)
+
+    def _normalize_surface(self, input_surface, statistics):
+        """Normalizes the surface fields [B, 4, H, W] (in fp32)"""
+        surface_mean, surface_std = statistics[0], statistics[1]
         input_surface = input_surface.reshape(
             input_surface.shape[0],
             input_surface.shape[1],
@@ -73,17 +177,50 @@ class PatchEmbedding_pretrain(nn.Module):
         input_surface = torch.permute(
             input_surface, (0, 2, 3, 4, 1)
         )  # [1,1,721,1440,4]
-        input_surface = (input_surface - self.surface_mean) / self.surface_std
+        # Normalization in fp32 (also under autocast)
+        input_surface = (input_surface.float() - surface_mean) / surface_std
 
         input_surface = torch.permute(
             input_surface, (0, 4, 1, 2, 3)
         )  # [1,4 1,721,1440]
-        input_surface = input_surface.view(
+        input_surface = input_surface.reshape(
             input_surface.shape[0],
             input_surface.shape[1],
             input_surface.shape[-2],
             input_surface.shape[-1],
         )  # [1,4,721,1440]
+        return input_surface
+
+    def _normalize_upper(self, input, statistics):
+        """Normalizes the upper-air fields [B, 5, 13, H, W] (in fp32), returns [B, 5, 1, 13, H, W]"""
+        upper_mean, upper_std = statistics[2], statistics[3]
+        input = input.reshape(
+            input.shape[0],
+            input.shape[1],
+            1,
+            input.shape[2],
+            input.shape[-2],
+            input.shape[-1],
+        )
+        input = torch.permute(input, (0, 2, 3, 4, 5, 1))  # [1,1,13,721,1440,5]
+        input = torch.flip(input, [2])  # [1,1,13,721,1440,5]
+        input = (input.float() - upper_mean) / upper_std  # [1,1,13,721,1440,5]
+        input = torch.permute(input, (0, 5, 1, 2, 3, 4))  # [1,5,1,13,721,1440]
+        input = torch.flip(input, [3])
+        return input
+
+    def forward_reference(self, input, input_surface, statistics, maps, const_h):
+        # input:(B, N, Z, H, W) input_surface(B,N,H,W)
+        # Zero-pad the input
+        self.surface_mean, self.surface_std, self.upper_mean, self.upper_std = (
+            statistics[0],
+            statistics[1],
+            statistics[2],
+            statistics[3],
+        )
+        self.constant_masks = maps
+
+        input_surface = self._normalize_surface(input_surface, statistics)
 
         input_surface = self.check_image_size_2d(input_surface)
 
@@ -120,20 +257,10 @@ class PatchEmbedding_pretrain(nn.Module):
             input_surface.shape[0], input_surface.shape[1], 1, 181, 360
         )
 
-        input = input.reshape(
-            input.shape[0],
-            input.shape[1],
-            1,
-            input.shape[2],
-            input.shape[-2],
-            input.shape[-1],
-        )
-        input = torch.permute(input, (0, 2, 3, 4, 5, 1))  # [1,1,13,721,1440,5]
-        input = torch.flip(input, [2])  # [1,1,13,721,1440,5]
-        input = (input - self.upper_mean) / self.upper_std  # [1,1,13,721,1440,5]
-        input = torch.permute(input, (0, 5, 1, 2, 3, 4))  # [1,5,1,13,721,1440]
-        input = torch.flip(input, [3])
-        input = torch.cat((input, const_h), dim=1)  # [1,6,1,13,721,1440]
+        input = self._normalize_upper(input, statistics)
+        input = torch.cat(
+            (input, const_h.expand(input.shape[0], *const_h.shape[1:])), dim=1
+        )  # [1,6,1,13,721,1440]
         input = input.reshape(
             input.shape[0],
             input.shape[1],
@@ -169,8 +296,44 @@ class PatchEmbedding_pretrain(nn.Module):
         return x
 
 
+class LayerNorm(nn.LayerNorm):
+    """LayerNorm that always normalizes in fp32, also under autocast (see cfg.PG.PRECISION). Returns fp32."""
+
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super().forward(x.float())
+
+
+def upgrade_layer_norms(state):
+    """Modules pickled before LayerNorm existed (e.g. an older best_model.pth) contain torch.nn.LayerNorm
+    children, they are turned into LayerNorm (same state) in the __setstate__ of their parent"""
+    for module in state["_modules"].values():
+        if type(module) is nn.LayerNorm:
+            module.__class__ = LayerNorm
+
+
+CHECKPOINT_POLICIES = ["none", "all", "every_other", "attention"]
+
+
+def needs_checkpoint(module, x):
+    """Checkpointing only saves memory if a backward pass follows, i.e. if gradients are enabled and flow
+    through the module (to its own parameters or to its input x). Decided at run time, so that inference and
+    frozen blocks run without re-forward."""
+    return torch.is_grad_enabled() and (
+        x.requires_grad or any(p.requires_grad for p in module.parameters())
+    )
+
+
 class EarthSpecificLayer(nn.Module):
-    def __init__(self, depth, dim, drop_path_ratio_list, heads, use_checkpoint, device):
+    def __init__(
+        self,
+        depth,
+        dim,
+        drop_path_ratio_list,
+        heads,
+        device,
+        checkpoint_policy=cfg.PG.CHECKPOINT_POLICY,
+    ):
         super(EarthSpecificLayer, self).__init__()
         self.device = device
         """Basic layer of our network, contains 2 or 6 blocks"""
@@ -182,29 +345,146 @@ class EarthSpecificLayer(nn.Module):
                 dim, drop_path_ratio_list[i_layer], heads, device=self.device
             )
         self.blocks = nn.Sequential(block_list)
-        self.use_checkpoint = use_checkpoint
         self.device = device
 
-    def forward(self, x, Z, H, W):
-        # # Roll the input every two blocks
-        i = -1
+        assert (
+            checkpoint_policy in CHECKPOINT_POLICIES
+        ), f"Unknown checkpoint policy: {checkpoint_policy}"
+        self.checkpoint_policy = checkpoint_policy
         for blk in self.blocks:
-            i += 1
-            if self.use_checkpoint:
-                if i % 2 == 0:
-                    x = checkpoint.checkpoint(
-                        blk, x, Z, H, W, False, use_reentrant=True
-                    )
-                else:
-                    x = checkpoint.checkpoint(blk, x, Z, H, W, True, use_reentrant=True)
+            blk.checkpoint_attention = checkpoint_policy == "attention"
+
+    def __setstate__(self, state):
+        # Layers pickled before the checkpoint policies (e.g. an older best_model.pth) have use_checkpoint instead
+        if "checkpoint_policy" not in state:
+            state["checkpoint_policy"] = (
+                "all" if state.pop("use_checkpoint", False) else "none"
+            )
+        super().__setstate__(state)
+
+    def checkpoint_block(self, i):
+        """Whether the policy checkpoints the i-th block as a whole"""
+        return self.checkpoint_policy == "all" or (
+            self.checkpoint_policy == "every_other" and i % 2 == 0
+        )
+
+    def forward(self, x, Z, H, W):
+        # The shift mask and the window partition indices are created outside of the blocks, so that compiled
+        # blocks (see compile_blocks) only see tensor inputs. All rolled blocks of the layer share the same mask
+        mask = self.blocks[0].gen_mask(x, Z, H)
+
+        # Roll the input every two blocks
+        for i, blk in enumerate(self.blocks):
+            roll = i % 2 == 1
+            blk_mask = mask if roll else None
+            blk_index = (
+                blk.gen_partition_index(x, Z, H, W, roll)
+                if blk.gather_partition
+                else None
+            )
+            if self.checkpoint_block(i) and needs_checkpoint(blk, x):
+                x = checkpoint.checkpoint(
+                    blk, x, Z, H, W, roll, blk_mask, blk_index, use_reentrant=False
+                )
             else:
-                if i % 2 == 0:
-                    x = blk(x, Z, H, W, roll=False)
-                else:
-                    x = blk(x, Z, H, W, roll=True)
+                x = blk(x, Z, H, W, roll=roll, mask=blk_mask, partition_index=blk_index)
         return x
 
 
+@functools.lru_cache(maxsize=None)
+def shifted_window_mask(Z, H, window_size, type_of_windows, device):
+    """Attention mask of the rolled (shifted) windows, shape (1, type_of_windows, 144, 144).
+    The mask only depends on the position of a window in Z and H, it is the same for all windows along the
+    longitude (which is periodic), so it is computed for a single window column and broadcast in the attention.
+    Cached per shape and device, the returned tensor must not be modified.
+    """
+    img_mask = torch.zeros((1, Z, H, window_size[2], 1), device=device)  # 1 Z H W 1
+    mB, mZ, mH, mW, mC = img_mask.shape
+    # 1x8x96x12x1
+    cnt = 0
+    z_slices = (
+        slice(0, -window_size[0]),
+        slice(-window_size[0], -window_size[0] // 2),
+        slice(-window_size[0] // 2, None),
+    )
+    h_slices = (
+        slice(0, -window_size[1]),
+        slice(window_size[1], -window_size[1] // 2),
+        slice(-window_size[1] // 2, None),
+    )
+    for z in z_slices:
+        for h in h_slices:
+            img_mask[:, z, h, :, :] = cnt
+            cnt += 1
+    img_mask = img_mask.reshape(
+        1,
+        mZ // window_size[0],
+        window_size[0],
+        mH // window_size[1],
+        window_size[1],
+        mW // window_size[2],
+        window_size[2],
+        1,
+    )
+    img_mask = torch.permute(img_mask, (0, 5, 1, 3, 2, 4, 6, 7))
+    mask_windows = img_mask.reshape(
+        -1,
+        type_of_windows,
+        window_size[0] * window_size[1] * window_size[2],
+    )  # （1，64，144）
+
+    attn_mask = mask_windows.unsqueeze(2) - mask_windows.unsqueeze(3)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
+        attn_mask == 0, float(0.0)
+    )
+
+    return attn_mask
+
+
+@functools.lru_cache(maxsize=None)
+def window_partition_index(Z, H, W, window_size, padding, roll, device):
+    """Position of each token of a Z x H x W grid (in token order) in the window layout of the padded (along H)
+    and optionally rolled grid. The window layout is the one of the window attention: windows ordered (W, Z, H),
+    pixels within a window ordered (Z, H, W). Positions of padding are not indexed.
+    Cached per shape and device, the returned tensor must not be modified.
+    """
+    padded_H = H + padding[0] + padding[1]
+    z, h, w = torch.meshgrid(
+        torch.arange(Z, device=device),
+        torch.arange(H, device=device),
+        torch.arange(W, device=device),
+        indexing="ij",
+    )
+    h = h + padding[0]
+    if roll:
+        # Same shifts as torch.roll in the reference path, position p moves to p - window_size // 2
+        z = (z - window_size[0] // 2) % Z
+        h = (h - window_size[1] // 2) % padded_H
+        w = (w - window_size[2] // 2) % W
+
+    # Index of the window, then of the pixel within the window
+    index = (w // window_size[2]) * (Z // window_size[0]) + z // window_size[0]
+    index = index * (padded_H // window_size[1]) + h // window_size[1]
+    index = (index * window_size[0] + z % window_size[0]) * window_size[1]
+    index = (index + h % window_size[1]) * window_size[2] + w % window_size[2]
+    return index.flatten()
+
+
+@functools.lru_cache(maxsize=None)
+def window_partition_inverse_index(Z, H, W, window_size, padding, roll, device):
+    """Inverse of window_partition_index: the token (in token order) at each position of the window layout, or
+    Z * H * W at positions of padding (an appended zero token). Gathering with it is the partition.
+    Cached per shape and device, the returned tensor must not be modified.
+    """
+    index = window_partition_index(Z, H, W, window_size, padding, roll, device)
+    padded_H = H + padding[0] + padding[1]
+    inverse = torch.full(
+        (Z * padded_H * W,), Z * H * W, dtype=index.dtype, device=device
+    )
+    inverse[index] = torch.arange(Z * H * W, device=device)
+    return inverse
+
+
 class EarthSpecificBlock(nn.Module):
     def __init__(self, dim, drop_path_ratio, heads, device):
         super(EarthSpecificBlock, self).__init__()
@@ -221,13 +501,16 @@ class EarthSpecificBlock(nn.Module):
         self.drop_path = (
             DropPath(drop_path_ratio) if drop_path_ratio > 0.0 else nn.Identity()
         )
-        self.norm1 = nn.LayerNorm(dim)
-        self.norm2 = nn.LayerNorm(dim)
+        self.norm1 = LayerNorm(dim)
+        self.norm2 = LayerNorm(dim)
         self.linear = Mlp(dim, 0)
         self.attention = EarthAttention3D(
             dim, heads, 0, self.window_size, device=self.device
         )
         self.padding_front, self.padding_back = 0, 5
+        # Set by EarthSpecificLayer for the "attention" checkpoint policy
+        self.checkpoint_attention = False
+        self.gather_partition = cfg.PG.GATHER_WINDOW_PARTITION
         # self.pad3D = nn.ConstantPad3d((0, 0, 0, 0, self.padding_front,  self.padding_back), 0)
         if dim == 192:
             input_shape = [8, 186]
@@ -237,64 +520,75 @@ class EarthSpecificBlock(nn.Module):
             input_shape[1] // self.window_size[1]
         )  # (8//2*186//6=124) (8//2*96//6=124=64)
 
-    def gen_mask(self, x):
-        img_mask = torch.zeros((1, x.shape[1], x.shape[2], x.shape[3], 1)).to(
-            self.device
-        )  # ? CHECK change to x.shape?  # 1 Z H W 1
-        mB, mZ, mH, mW, mC = img_mask.shape
-        # 1x8x96x180x1
-        cnt = 0
-        z_slices = (
-            slice(0, -self.window_size[0]),
-            slice(-self.window_size[0], -self.window_size[0] // 2),
-            slice(-self.window_size[0] // 2, None),
-        )
-        h_slices = (
-            slice(0, -self.window_size[1]),
-            slice(self.window_size[1], -self.window_size[1] // 2),
-            slice(-self.window_size[1] // 2, None),
-        )
-        for z in z_slices:
-            for h in h_slices:
-                img_mask[:, z, h, :, :] = cnt
-                cnt += 1
-        img_mask = img_mask.reshape(
-            1,
-            mZ // self.window_size[0],
-            self.window_size[0],
-            mH // self.window_size[1],
-            self.window_size[1],
-            mW // self.window_size[2],
-            self.window_size[2],
-            1,
-        )
-        img_mask = torch.permute(img_mask, (0, 5, 1, 3, 2, 4, 6, 7))
-        mask_windows = img_mask.reshape(
-            -1,
+    def __setstate__(self, state):
+        # Blocks pickled before the attention checkpoint policy and the gather window partition existed
+        state.setdefault("checkpoint_attention", False)
+        state.setdefault("gather_partition", cfg.PG.GATHER_WINDOW_PARTITION)
+        upgrade_layer_norms(state)
+        super().__setstate__(state)
+
+    def gen_mask(self, x, Z, H):
+        """Returns the attention mask of the rolled windows of x (tokens of a Z x H x W grid), shape
+        (1, type_of_windows, 144, 144). Computed once per shape and device (see shifted_window_mask)."""
+        return shifted_window_mask(
+            Z,
+            H + self.padding_front + self.padding_back,
+            self.window_size,
             self.type_of_windows,
-            self.window_size[0],
-            self.window_size[1],
-            self.window_size[2],
-            1,
+            x.device,
         )
 
-        mask_windows = mask_windows.view(
-            -1,
-            self.type_of_windows,
-            self.window_size[0] * self.window_size[1] * self.window_size[2],
-        )  # （15，64，144）
+    def _attention(self, x_window, mask):
+        """Window attention, checkpointed for the "attention" checkpoint policy"""
+        if self.checkpoint_attention and needs_checkpoint(self.attention, x_window):
+            return checkpoint.checkpoint(
+                self.attention, x_window, mask, use_reentrant=False
+            )
+        return self.attention(x_window, mask)
 
-        attn_mask = mask_windows.unsqueeze(2) - mask_windows.unsqueeze(3)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
-            attn_mask == 0, float(0.0)
+    def gen_partition_index(self, x, Z, H, W, roll):
+        """Returns the indices of the gather window partition of x (tokens of a Z x H x W grid), a tuple of
+        window_partition_index and window_partition_inverse_index. Computed once per shape and device.
+        Created outside of compiled blocks: as constants of the graph, the indices do not compile."""
+        args = (
+            Z,
+            H,
+            W,
+            self.window_size,
+            (self.padding_front, self.padding_back),
+            roll,
+            x.device,
+        )
+        return window_partition_index(*args), window_partition_inverse_index(*args)
+
+    def _window_attention_gather(self, x, Z, H, W, roll, mask, partition_index=None):
+        """Same result as _window_attention_reference with three copies of x instead of about five:
+        pad, roll and window partition are a single gather of the tokens and an appended zero token (see
+        window_partition_inverse_index), reverse, roll back and crop a single gather (see window_partition_index)."""
+        B, L, C = x.shape
+        if roll and mask is None:
+            mask = self.gen_mask(x, Z, H)
+        if partition_index is None:
+            partition_index = self.gen_partition_index(x, Z, H, W, roll)
+        index, inverse_index = partition_index
+        Hp = H + self.padding_front + self.padding_back
+
+        # Pad, roll and partition, [1, 521280, 192] -> [30, 124, 144, 192]
+        x_window = F.pad(x, (0, 0, 0, 1)).index_select(1, inverse_index)
+        x_window = x_window.view(
+            B * (W // self.window_size[2]),
+            (Z // self.window_size[0]) * (Hp // self.window_size[1]),
+            self.window_size[0] * self.window_size[1] * self.window_size[2],
+            C,
         )
 
-        return attn_mask
+        attn_windows = self._attention(x_window, mask)
 
-    def forward(self, x, Z, H, W, roll):
-        # Save the shortcut for skip-connection
-        shortcut = x  # torch.Size([1, 521280, 192]) -- ([1, 131040, 384])
+        # Reverse, roll back and crop, [30, 124, 144, 192] -> [1, 521280, 192]
+        return attn_windows.reshape(B, -1, C).index_select(1, index)
 
+    def _window_attention_reference(self, x, Z, H, W, roll, mask):
+        """Window attention of the original implementation: pad, roll, partition, attention, reverse, roll back, crop"""
         # Reshape input to three dimensions to calculate window attention
         x = x.view(
             x.shape[0], Z, H, W, x.shape[2]
@@ -322,11 +616,9 @@ class EarthSpecificBlock(nn.Module):
             # Generate mask of attention masks
             # If two pixels are not adjacent, then mask the attention between them
             # Your can set the matrix element to -1000 when it is not adjacent, then add it to the attention
-            """
-      To do: generate mask
-      """
-            mask = self.gen_mask(x)
-            # mask = None
+            # (usually precomputed by EarthSpecificLayer)
+            if mask is None:
+                mask = self.gen_mask(x, Z, H)
 
         else:
             # e.g., zero matrix when you add mask to attention
@@ -347,14 +639,15 @@ class EarthSpecificBlock(nn.Module):
         x_window = torch.permute(
             x_window, (0, 5, 1, 3, 2, 4, 6, 7)
         )  # 1,30,4,31,2,6,12,192
+        # The batch is folded into the longitude windows, the window types stay in their own dimension
         x_window = x_window.reshape(
-            x_window.shape[1],
+            x_window.shape[0] * x_window.shape[1],
             x_window.shape[2] * x_window.shape[3],
             x_window.shape[4],
             x_window.shape[5],
             x_window.shape[6],
             x_window.shape[7],
-        )  # nW*B, window_size*window_size,
+        )  # B*nW, window_size*window_size,
         # x_window (30,124,2,6,12,192)
         x_window = x_window.contiguous().view(
             x_window.shape[0],
@@ -363,17 +656,17 @@ class EarthSpecificBlock(nn.Module):
             x_window.shape[-1],
         )
         # Apply 3D window attention with Earth-Specific bias
-        attn_windows = self.attention(
+        attn_windows = self._attention(
             x_window, mask
         )  # ？x_window:([30, 124, 144, 192]) -[15, 64, 144, 384])
 
         # Reorganize data to original shapes
         # x_shifted = attn_windows.view(-1, Z // self.window_size[0], H // self.window_size[1] + 1, W //self.window_size[2], self.window_size[0], self.window_size[1], self.window_size[2], x_window.shape[-1])
         x_shifted = attn_windows.view(
-            1,
-            attn_windows.shape[0],
-            Z // self.window_size[0],
-            H // self.window_size[1] + 1,
+            ori_shape[0],
+            ori_shape[3] // self.window_size[2],
+            ori_shape[1] // self.window_size[0],
+            ori_shape[2] // self.window_size[1],
             self.window_size[0],
             self.window_size[1],
             self.window_size[2],
@@ -412,6 +705,19 @@ class EarthSpecificBlock(nn.Module):
             x.shape[0], x.shape[1] * x.shape[2] * x.shape[3], x.shape[4]
         )
 
+        return x
+
+    def forward(self, x, Z, H, W, roll, mask=None, partition_index=None):
+        # Save the shortcut for skip-connection
+        shortcut = x  # torch.Size([1, 521280, 192]) -- ([1, 131040, 384])
+
+        # Window attention, the partition and reverse of the windows are either index gathers or the reference
+        # pad/roll/permute path (see cfg.PG.GATHER_WINDOW_PARTITION)
+        if self.gather_partition:
+            x = self._window_attention_gather(x, Z, H, W, roll, mask, partition_index)
+        else:
+            x = self._window_attention_reference(x, Z, H, W, roll, mask)
+
         # Main calculation stages
         x = shortcut + self.drop_path(self.norm1(x))
         x = x + self.drop_path(self.norm2(self.linear(x)))
@@ -452,6 +758,10 @@ class EarthAttention3D(nn.Module):
         self.linear2 = nn.Linear(dim, dim)
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout_rate)
+        self.backend = cfg.PG.ATTENTION_BACKEND  # "math" or "sdpa"
+        self.cache_bias = cfg.PG.CACHE_ATTENTION_BIAS
+        # (key, earth_specific_bias + mask), see _attention_bias
+        self._bias_cache = None
 
         # Store several attributes
         self.head_number = heads
@@ -564,6 +874,13 @@ class EarthAttention3D(nn.Module):
         )  # qkv torch.Size([3, 30, 124, 6, 144, 32])
         query, key, value = qkv[0], qkv[1], qkv[2]
 
+        if self.backend == "sdpa":
+            x = self._sdpa(query, key, value, mask)
+            x = torch.reshape(x, shape=original_shape)
+            x = self.linear2(x)
+            x = self.dropout(x)
+            return x
+
         # Scale the attention
         query = query * self.scale
 
@@ -585,33 +902,10 @@ class EarthAttention3D(nn.Module):
         # # #torch.Size([144, 144, 124, 6])
         # EarthSpecificBias = torch.permute(EarthSpecificBias, (2, 3, 0, 1))#torch.Size([124,6,144, 144])
         # EarthSpecificBias = EarthSpecificBias.unsqueeze(0)# ->[1,124,6,144, 144]
-        EarthSpecificBias = self.earth_specific_bias
-
-        # Add the Earth-Specific bias to the attention matrix
-        attention = attention + EarthSpecificBias  # ([30, 124, 6, 144, 144])
-        # attention = attention + EarthSpecificBias#([30, 124, 6, 144, 144])
-
-        # Mask the attention between non-adjacent pixels, e.g., simply add -100 to the masked element.
-        if mask is not None:
-            nW = mask.shape[0]  # mask: 15x64x144x144
-            attention = attention.view(
-                1,
-                nW,
-                self.type_of_windows,
-                self.head_number,
-                self.window_size[0] * self.window_size[1] * self.window_size[2],
-                self.window_size[0] * self.window_size[1] * self.window_size[2],
-            ) + mask.unsqueeze(2).unsqueeze(0)  # 1x15x64x1x144x144
-            attention = attention.reshape(
-                nW,
-                self.type_of_windows,
-                self.head_number,
-                self.window_size[0] * self.window_size[1] * self.window_size[2],
-                self.window_size[0] * self.window_size[1] * self.window_size[2],
-            )
-            attention = self.softmax(attention)
-        else:
-            attention = self.softmax(attention)
+        # Add the Earth-Specific bias to the attention matrix, for rolled blocks together with the mask of the
+        # attention between non-adjacent pixels (adds -100 to the masked elements)
+        attention += self._attention_bias(mask)  # ([30, 124, 6, 144, 144])
+        attention = self.softmax(attention)
         attention = self.dropout(attention)
 
         # Calculated the tensor after spatial mixing.
@@ -628,6 +922,81 @@ class EarthAttention3D(nn.Module):
 
         return x
 
+    def _sdpa(self, query, key, value, mask):
+        """Window attention with torch.nn.functional.scaled_dot_product_attention.
+        Same result as the "math" backend, the attention scores are not materialized by fused kernels.
+        query, key, value: [30, 124, 6, 144, 32], returns [30, 124, 144, 6, 32]
+        """
+        nW, types, heads, N, E = query.shape
+
+        # Earth-Specific bias and shift mask form one additive mask, shared by all windows along the longitude
+        attn_bias = self._attention_bias(mask)  # [1, 124, 6, 144, 144]
+        attn_bias = attn_bias.reshape(1, types * heads, N, N).expand(nW, -1, -1, -1)
+
+        # Fused kernels require 4D inputs: window types and heads share one dimension
+        x = F.scaled_dot_product_attention(
+            query.reshape(nW, types * heads, N, E),
+            key.reshape(nW, types * heads, N, E),
+            value.reshape(nW, types * heads, N, E),
+            attn_mask=attn_bias.to(query.dtype),
+            dropout_p=self.dropout.p if self.training else 0.0,
+            scale=self.scale,
+        )  # [30, 744, 144, 32]
+
+        x = x.view(nW, types, heads, N, E)
+        return torch.permute(x, (0, 1, 3, 2, 4))  # [30, 124, 144, 6, 32]
+
+    def _attention_bias(self, mask):
+        """Returns the Earth-Specific bias plus the shift mask (if any), shape [1, 124, 6, 144, 144].
+        While the bias is constant (frozen or gradients disabled), the sum is computed once and reused until the
+        bias, its device or dtype, or the mask change.
+        """
+        bias = self.earth_specific_bias
+        if mask is None:
+            return bias
+        if (
+            not self.cache_bias
+            or (torch.is_grad_enabled() and bias.requires_grad)
+            or torch.compiler.is_compiling()
+        ):
+            # Compiled graphs fuse the add, the Python-side cache would only cause graph breaks
+            return bias + mask.unsqueeze(2)
+
+        key = (bias._version, bias.data_ptr(), bias.dtype, mask.data_ptr())
+        if self._bias_cache is None or self._bias_cache[0] != key:
+            self._bias_cache = (key, (bias + mask.unsqueeze(2)).detach())
+        return self._bias_cache[1]
+
+    def __getstate__(self):
+        # The cached bias is not copied or pickled (e.g. with the best model)
+        state = self.__dict__.copy()
+        state["_bias_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Modules pickled before the attention backends and the bias cache existed (e.g. an older best_model.pth)
+        state.setdefault("backend", cfg.PG.ATTENTION_BACKEND)
+        state.setdefault("cache_bias", cfg.PG.CACHE_ATTENTION_BIAS)
+        state.setdefault("_bias_cache", None)
+        super().__setstate__(state)
+
+
+def compile_blocks(model, **kwargs):
+    """Compiles the EarthSpecificBlocks of a model in place with torch.compile (kwargs are passed on).
+    The blocks have fixed shapes and consist of long view/permute/pad/roll chains, which compile well. Parameter
+    names (and thus checkpoints) are not changed, other than with torch.compile(model)."""
+    for module in model.modules():
+        if isinstance(module, EarthSpecificBlock):
+            module.compile(**kwargs)
+
+
+def set_attention_backend(model, backend):
+    """Sets the window attention backend ("math" or "sdpa") of all EarthAttention3D modules of a model"""
+    assert backend in ["math", "sdpa"], f"Unknown attention backend: {backend}"
+    for module in model.modules():
+        if isinstance(module, EarthAttention3D):
+            module.backend = backend
+
 
 class DownSample(nn.Module):  # can check siwnir's up and downsample
     def __init__(self, dim):
@@ -635,9 +1004,13 @@ class DownSample(nn.Module):  # can check siwnir's up and downsample
         """Down-sampling operation"""
         # A linear function and a layer normalization
         self.linear = nn.Linear(in_features=4 * dim, out_features=2 * dim, bias=False)
-        self.norm = nn.LayerNorm(4 * dim)
+        self.norm = LayerNorm(4 * dim)
         # self.Pad3D = nn.ConstantPad3d((0, 0, 0, 0, 0, 1),0)
 
+    def __setstate__(self, state):
+        upgrade_layer_norms(state)
+        super().__setstate__(state)
+
     def forward(self, x, Z, H, W):
         # print(x.shape)
 
@@ -679,19 +1052,23 @@ class UpSample(nn.Module):
         self.linear2 = nn.Linear(output_dim, output_dim, bias=False)
 
         # Normalization
-        self.norm = nn.LayerNorm(output_dim)
+        self.norm = LayerNorm(output_dim)
 
-    def forward(self, x):
+    def __setstate__(self, state):
+        upgrade_layer_norms(state)
+        super().__setstate__(state)
+
+    def forward(self, x, Z, H, W):
         # Call the linear functions to increase channels of the data
         x = self.linear1(x)
 
         # Reorganize x to increase the resolution: simply change the order and upsample from (8, 180, 91) to (8, 360, 182)
         # Reshape x to facilitate upsampling.
-        x = x.view(x.shape[0], 8, 91, 180, 2, 2, x.shape[-1] // 4)
+        x = x.view(x.shape[0], Z, H, W, 2, 2, x.shape[-1] // 4)
         # Change the order of x
         x = torch.permute(x, (0, 1, 2, 4, 3, 5, 6))  # ([1, 8, 91, 2, 180, 2, 192])
         # Reshape to get Tensor with a resolution of (8, 360, 182)
-        x = x.contiguous().view(x.shape[0], 8, 182, 360, x.shape[-1])  #
+        x = x.contiguous().view(x.shape[0], Z, 2 * H, 2 * W, x.shape[-1])  #
 
         # Crop the output to the input shape of the network
         # x = Crop3D(x)
@@ -834,33 +1211,8 @@ class PatchRecoveryPowerSurface(nn.Module):
         - Only surface level is used
         - Convolution with lower output channels to reduce the output to one variable insted of 4
         """
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        # Slice out surface data
-        output = x[:, :, 0, :, :]  # [1, 384, 181, 360]
-
-        # Flatten
-        output = output.view(output.shape[0], self.dim, -1)  # [1, 384, 65160]
-
-        # Apply convolution
-        output = self.conv(output)  # [1, 16, 65160]
-
-        # Recover [724, 1440] shape
-        output = output.view(
-            output.shape[0], 1, self.patch_size[1], self.patch_size[2], H, W
-        )  # [1, 1, 4, 4, 181, 360]
-        output = torch.permute(output, (0, 1, 4, 2, 5, 3))  # [1, 1, 181, 4, 360, 4]
-        output = output.reshape(output.shape[0], 1, 724, 1440)  # [1, 1, 724, 1440]
-
-        # Remove padding
-        height_slice = slice(0, 724 - 3)
-        output = output[:, :, height_slice, :]  # [1, 1, 721, 1440]
-        output = output.view(output.shape[0], 1, 1, 721, 1440)  # [1, 1, 1, 721, 1440]
-        # output_surface = output_surface * self.surface_std + self.surface_mean
-        output = output.view(output.shape[0], 1, 721, 1440)  # [1, 1, 721, 1440]
-        return output
+        # Only the surface level is recovered, all 16 output channels are pixels of the power patches
+        return _recover_level(x, Z, H, W, 0, self.conv.weight, self.conv.bias)
 
 
 class PatchRecoveryPowerSurface_2(nn.Module):
@@ -890,46 +1242,10 @@ class PatchRecoveryPowerSurface_2(nn.Module):
         -------
         Power output
         """
-        # The inverse operation of the patch embedding operation, patch_size = (2, 4, 4) as in the original paper
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        height_slice = slice(0, 724 - 3)
-
-        # Slice out surface data
-        output_surface = x[:, :, 0, :, :]  # [1, 384, 181, 360]
-
-        # Flatten
-        output_surface = output_surface.view(
-            output_surface.shape[0], self.dim, -1
-        )  # [1, 384, 65160]
-
-        # Apply surface convolution
-        output_surface = self.conv_surface(output_surface)  # [1, 64, 65160]
-
-        # Recover [724, 1440] shape
-        output_surface = output_surface.view(
-            output_surface.shape[0], 4, self.patch_size[1], self.patch_size[2], H, W
-        )  # [1, 4, 4, 4, 181, 360]
-        output_surface = torch.permute(
-            output_surface, (0, 1, 4, 2, 5, 3)
-        )  # [1, 4, 181, 4, 360, 4]
-        output_surface = output_surface.reshape(
-            output_surface.shape[0], 4, 724, 1440
-        )  # [1, 4, 724, 1440]
-
-        # Remove apdding
-        output_surface = output_surface[:, :, height_slice, :]  # [1, 4, 721, 1440]
-        output_surface = output_surface.view(
-            output_surface.shape[0], 4, 1, 721, 1440
-        )  # [1, 4, 1, 721, 1440]
-        # output_surface = output_surface * self.surface_std + self.surface_mean
-        output_surface = output_surface.view(
-            output_surface.shape[0], 4, 721, 1440
-        )  # [1, 4, 721, 1440]
-
-        output_surface = output_surface[:, 0:1, :, :]  # [1, 1, 721, 1440]
+        # Only the output channels of the first variable (the first 16, its pixels) are computed
+        output_surface = _recover_level(
+            x, Z, H, W, 0, self.conv_surface.weight[:16], self.conv_surface.bias[:16]
+        )  # [1, 1, 721, 1440]
 
         # Clipped ReLU
         output_surface = clipped_relu(output_surface)
@@ -952,52 +1268,11 @@ class PatchRecoveryPowerUpper(nn.Module):
         - Only upper levels are used
         - Convolution with lower output channels to reduce the output to one variable insted of 4
         """
-        # The inverse operation of the patch embedding operation, patch_size = (2, 4, 4) as in the original paper
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        # Slice out atmospheric data
-        output = x[:, :, 1:, :, :]  # [1, 384, 7, 181, 360]
-
-        # Flatten
-        output = output.view(output.shape[0], output.shape[1], -1)  # [1, 384, 456120]
-
-        # Apply upper convolution
-        output = self.conv(output)  # [1, 32, 456120]
-
-        # Recover [724, 1440] shape
-        output = output.reshape(
-            output.shape[0],
-            1,
-            self.patch_size[0],
-            self.patch_size[1],
-            self.patch_size[2],
-            Z - 1,
-            H,
-            W,
-        )  # [1, 1, 2, 4, 4, 7, 181, 360]
-        output = torch.permute(
-            output, (0, 1, 5, 2, 6, 3, 7, 4)
-        )  # [1, 1, 7, 2, 181, 4, 360, 4]
-        output = output.reshape(
-            output.shape[0], 1, 14, 724, 1440
-        )  # [1, 1, 14, 724, 1440]
-
-        # Remove padding
-        depth_slice = slice(0, output.shape[-3] - 1)
-        height_slice = slice(0, output.shape[-2] - 3)
-        output = output[:, :, depth_slice, height_slice, :]  # [1, 1, 13, 721, 1440]
-        output = output.view(
-            output.shape[0], 1, 1, 13, 721, 1440
-        )  # [1, 1, 1, 13, 721, 1440]
-        output = output.view(output.shape[0], 1, 13, 721, 1440)  # [1, 1, 13, 721, 1440]
-
-        # Slice out lowest level
-        output = output[:, :, 0, :, :]  # [1, 1, 1, 721, 1440]
-        output = output.view(output.shape[0], 1, 721, 1440)  # [1, 1, 721, 1440]
-
-        return output
+        # The lowest pressure level is the first level of the first upper-air patch level (token level 1), only
+        # its output channels (the first 16) are computed
+        return _recover_level(
+            x, Z, H, W, 1, self.conv.weight[:16], self.conv.bias[:16]
+        )  # [1, 1, 721, 1440]
 
 
 class PatchRecoveryPowerUpper_2(nn.Module):
@@ -1028,50 +1303,10 @@ class PatchRecoveryPowerUpper_2(nn.Module):
         -------
         Power output
         """
-        # The inverse operation of the patch embedding operation, patch_size = (2, 4, 4) as in the original paper
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        # Slice out atmospheric data
-        output = x[:, :, 1:, :, :]  # [1, 384, 7, 181, 360]
-
-        # Flatten
-        output = output.view(output.shape[0], output.shape[1], -1)  # [1, 384, 456120]
-
-        # Apply upper convolution
-        output = self.conv(output)  # [1, 160, 456120]
-
-        # Recover [724, 1440] shape
-        output = output.reshape(
-            output.shape[0],
-            5,
-            self.patch_size[0],
-            self.patch_size[1],
-            self.patch_size[2],
-            Z - 1,
-            H,
-            W,
-        )  # [1, 5, 2, 4, 4, 7, 181, 360]
-        output = torch.permute(
-            output, (0, 1, 5, 2, 6, 3, 7, 4)
-        )  # [1, 5, 7, 2, 181, 4, 360, 4]
-        output = output.reshape(
-            output.shape[0], 5, 14, 724, 1440
-        )  # [1, 5, 14, 724, 1440]
-
-        # Remove padding
-        depth_slice = slice(0, output.shape[-3] - 1)
-        height_slice = slice(0, output.shape[-2] - 3)
-        output = output[:, :, depth_slice, height_slice, :]  # [1, 5, 13, 721, 1440]
-        output = output.view(
-            output.shape[0], 5, 1, 13, 721, 1440
-        )  # [1, 5, 1, 13, 721, 1440]
-        output = output.view(output.shape[0], 5, 13, 721, 1440)  # [1, 5, 13, 721, 1440]
-
-        # Slice out one level
-        output = output[:, 0, 0, :, :]  # [1, 721, 1440]
-        output = output.unsqueeze(1)  # [1, 1, 721, 1440]
+        # Only the first variable on the lowest pressure level (first 16 output channels, token level 1) is computed
+        output = _recover_level(
+            x, Z, H, W, 1, self.conv.weight[:16], self.conv.bias[:16]
+        )  # [1, 1, 721, 1440]
 
         # Clipped ReLU
         output = clipped_relu(output)
@@ -1080,62 +1315,73 @@ class PatchRecoveryPowerUpper_2(nn.Module):
 
 
 class PatchRecoveryPowerAll(nn.Module):
-    def __init__(self, dim):
+    def __init__(self, dim, roi=cfg.POWER.ROI):
         super().__init__()
         """Patch recovery operation"""
         self.patch_size = (2, 4, 4)
         self.dim = dim  # 384
+        self.roi = roi  # Only compute the region of interest (see cfg.POWER.ROI)
 
         self.conv = nn.Conv1d(in_channels=dim, out_channels=16, kernel_size=1, stride=1)
 
+    def __setstate__(self, state):
+        # Modules pickled before the ROI mode existed compute the full grid
+        state.setdefault("roi", False)
+        super().__setstate__(state)
+
     def forward(self, x, Z, H, W):  # x: [1, 521280, 384], Z: 8, H: 181, W: 360
         """Adaption of the original forward pass of the PatchRecivery (PatchRecovery_pretrain).
         See the original forward pass for more details.
         - All pressure-levels are used
         """
-        # The inverse operation of the patch embedding operation, patch_size = (2, 4, 4) as in the original paper
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        # Flatten
-        output = x.view(x.shape[0], x.shape[1], -1)  # [1, 384, 521280]
-
-        # Apply upper convolution
-        output = self.conv(output)  # [1, 32, 521280]
-
-        # Recover [724, 1440] shape
-        output = output.reshape(
-            output.shape[0],
-            1,
-            1,
-            self.patch_size[1],
-            self.patch_size[2],
-            Z,
-            H,
-            W,
-        )  # [1, 1, 1, 4, 4, 8, 181, 360]
-        output = torch.permute(
-            output, (0, 1, 5, 2, 6, 3, 7, 4)
-        )  # [1, 1, 8, 1, 181, 4, 360, 4]
+        if self.roi:
+            return self.forward_roi(x, Z, H, W)
+
+        # Only the lowest level (token level 0) is kept, the other levels are not recovered
+        return _recover_level(
+            x, Z, H, W, 0, self.conv.weight, self.conv.bias
+        )  # [1, 1, 721, 1440]
+
+    def forward_roi(self, x, Z, H, W):  # x: [1, 521280, 384], Z: 8, H: 181, W: 360
+        """Same output as forward, cropped to the region of interest ([1, 1, 185, 271] for Europe).
+        Only the lowest level is kept by forward, so the convolution is only applied to the level 0 tokens
+        of the patches covering the region.
+        """
+        row_start, row_stop = cfg.POWER.ROI_ROWS
+        col_start, col_stop = cfg.POWER.ROI_COLS
+        p_h, p_w = self.patch_size[1], self.patch_size[2]
+
+        # Patches covering the ROI (patch rows 17..63 and columns -22..45 for Europe)
+        patch_row_start, patch_row_stop = row_start // p_h, -(-row_stop // p_h)
+        patch_col_start, patch_col_stop = col_start // p_w, -(-col_stop // p_w)
+        patch_cols = torch.arange(patch_col_start, patch_col_stop, device=x.device) % W
+
+        # Tokens are ordered (Z, H, W), select level 0 and the ROI patches
+        x = x.view(x.shape[0], Z, H, W, x.shape[-1])[:, 0]  # [1, 181, 360, 384]
+        x = x[:, patch_row_start:patch_row_stop].index_select(
+            2, patch_cols
+        )  # [1, 47, 68, 384]
+
+        # Kernel size 1 convolution on the selected tokens, [1, 47, 68, 16]
+        output = F.linear(x, self.conv.weight.squeeze(-1), self.conv.bias)
+
+        # Recover the pixels of the patches, output channel c is pixel (c // 4, c % 4) of its patch
+        output = output.view(*output.shape[:3], p_h, p_w)  # [1, 47, 68, 4, 4]
+        output = torch.permute(output, (0, 1, 3, 2, 4))  # [1, 47, 4, 68, 4]
         output = output.reshape(
-            output.shape[0], 1, 8, 724, 1440
-        )  # [1, 1, 8, 724, 1440]
+            output.shape[0], output.shape[1] * p_h, output.shape[3] * p_w
+        )  # [1, 188, 272]
 
-        # Remove padding
-        depth_slice = slice(0, output.shape[-3] - 1)
-        height_slice = slice(0, output.shape[-2] - 3)
-        output = output[:, :, depth_slice, height_slice, :]  # [1, 1, 7, 721, 1440]
-        output = output.view(
-            output.shape[0], 1, 1, 7, 721, 1440
-        )  # [1, 1, 1, 7, 721, 1440]
-        output = output.view(output.shape[0], 1, 7, 721, 1440)  # [1, 1, 15, 721, 1440]
-
-        # Slice out lowest level
-        output = output[:, :, 0, :, :]  # [1, 1, 1, 721, 1440]
-        output = output.view(output.shape[0], 1, 721, 1440)  # [1, 1, 721, 1440]
+        # Crop the patches to the ROI
+        row_offset = row_start - patch_row_start * p_h
+        col_offset = col_start - patch_col_start * p_w
+        output = output[
+            :,
+            row_offset : row_offset + row_stop - row_start,
+            col_offset : col_offset + col_stop - col_start,
+        ]  # [1, 185, 271]
 
-        return output
+        return output.unsqueeze(1)  # [1, 1, 185, 271]
 
 
 class PatchRecoveryPowerAll_2(nn.Module):
@@ -1156,46 +1402,10 @@ class PatchRecoveryPowerAll_2(nn.Module):
         See the original forward pass for more details.
         - All pressure-levels are used
         """
-        # The inverse operation of the patch embedding operation, patch_size = (2, 4, 4) as in the original paper
-        # Reshape x back to three dimensions
-        x = torch.permute(x, (0, 2, 1))  # [1, 384, 521280]
-        x = x.view(x.shape[0], x.shape[1], Z, H, W)  # [1, 384, 8, 181, 360]
-
-        # Flatten
-        output = x.view(x.shape[0], x.shape[1], -1)  # [1, 384, 521280]
-
-        # Apply upper convolution
-        output = self.conv(output)  # [1, 32, 521280]
-
-        # Recover [724, 1440] shape
-        output = output.reshape(
-            output.shape[0],
-            5,
-            self.patch_size[0],
-            self.patch_size[1],
-            self.patch_size[2],
-            Z,
-            H,
-            W,
-        )  # [1, 5, 2, 4, 4, 8, 181, 360]
-        output = torch.permute(
-            output, (0, 1, 5, 2, 6, 3, 7, 4)
-        )  # [1, 5, 8, 2, 181, 4, 360, 4]
-        output = output.reshape(
-            output.shape[0], 5, 16, 724, 1440
-        )  # [1, 5, 16, 724, 1440]
-
-        # Remove padding
-        depth_slice = slice(0, output.shape[-3] - 1)
-        height_slice = slice(0, output.shape[-2] - 3)
-        output = output[:, :, depth_slice, height_slice, :]  # [1, 5, 15, 721, 1440]
-        output = output.view(
-            output.shape[0], 5, 1, 15, 721, 1440
-        )  # [1, 5, 1, 15, 721, 1440]
-        output = output.view(output.shape[0], 5, 15, 721, 1440)  # [1, 5, 15, 721, 1440]
-        # Slice out lowest level and first variable
-        output = output[:, 0, 0, :, :]  # [1, 1, 1, 721, 1440]
-        output = output.view(output.shape[0], 1, 721, 1440)  # [1, 1, 721, 1440]
+        # Only the first variable on the lowest level (first 16 output channels, token level 0) is computed
+        output = _recover_level(
+            x, Z, H, W, 0, self.conv.weight[:16], self.conv.bias[:16]
+        )  # [1, 1, 721, 1440]
 
         output = clipped_relu(output)
 
@@ -1217,8 +1427,11 @@ class PowerConv(nn.Module):
     Attributes:
         conv_layers (nn.Sequential): A sequential container of convolutional layers,
                                      batch normalization layers, and ReLU activation functions.
+        fused (bool): Whether the layers are fused for inference (see fuse).
     """
 
+    fused = False
+
     def __init__(
         self,
         in_channels=cfg.POWERCONV.IN_CHANNELS,
@@ -1226,6 +1439,7 @@ class PowerConv(nn.Module):
         kernel_size=cfg.POWERCONV.KERNEL_SIZE,
         stride=cfg.POWERCONV.STRIDE,
         padding=cfg.POWERCONV.PADDING,
+        roi=cfg.POWER.ROI,
     ):
         """
         Initializes the PowerPanguConv class with the given parameters. Applies clipped relu function at the end.
@@ -1235,6 +1449,7 @@ class PowerConv(nn.Module):
             kernel_size (int or tuple): Size of the convolving kernel. Default is 1.
             stride (int or tuple): Stride of the convolution. Default is 1.
             padding (int or tuple): Zero-padding added to both sides of the input. Default is 1.
+            roi (bool): Only compute the region of interest (see cfg.POWER.ROI). Default is cfg.POWER.ROI.
         """
         super().__init__()
 
@@ -1275,10 +1490,58 @@ class PowerConv(nn.Module):
 
         self.conv_layers = nn.Sequential(*layers)  # Combine layers sequentially
 
+        # In ROI mode the inputs are cropped with a halo of the summed paddings, the convolutions then run
+        # without padding. This is only exact for convolutions that preserve the size
+        self.roi = roi
+        self.halo = 0
+        if roi:
+            for layer in self.conv_layers:
+                if isinstance(layer, nn.Conv2d):
+                    k, p = layer.kernel_size[0], layer.padding[0]
+                    assert layer.stride == (1, 1) and layer.kernel_size == (k, k)
+                    assert layer.padding == (p, p) and k == 2 * p + 1
+                    self.halo += p
+
+        # Channels of the used variables in the full upper and surface fields
+        self.upper_index = utils_data.variableIndex(
+            cfg.POWERCONV.UPPER_VARIABLES, cfg.ERA5_UPPER_VARIABLES
+        )
+        self.surface_index = utils_data.variableIndex(
+            cfg.POWERCONV.SURFACE_VARIABLES, cfg.ERA5_SURFACE_VARIABLES
+        )
+
+    def __setstate__(self, state):
+        # Modules pickled before these attributes existed (e.g. an older best_model.pth) get their defaults, the
+        # ROI mode did not exist, they compute the full grid
+        state.setdefault("roi", False)
+        state.setdefault("halo", 0)
+        if "upper_index" not in state:
+            state["upper_index"] = utils_data.variableIndex(
+                cfg.POWERCONV.UPPER_VARIABLES, cfg.ERA5_UPPER_VARIABLES
+            )
+            state["surface_index"] = utils_data.variableIndex(
+                cfg.POWERCONV.SURFACE_VARIABLES, cfg.ERA5_SURFACE_VARIABLES
+            )
+        super().__setstate__(state)
+
+    def select_variables(self, output_upper, output_surface):
+        """Slices out the used (wind) variables, inputs that contain only these variables are returned as they are"""
+        if output_upper.size(1) == len(cfg.ERA5_UPPER_VARIABLES):
+            output_upper = output_upper[:, self.upper_index, :, :, :]
+        if output_surface.size(1) == len(cfg.ERA5_SURFACE_VARIABLES):
+            output_surface = output_surface[:, self.surface_index, :, :]
+        return output_upper, output_surface
+
     def forward(self, output_upper, output_surface):
-        # Slice out wind variables
-        output_upper = output_upper[:, -2:, :, :, :]
-        output_surface = output_surface[:, 1:3, :, :]
+        # Slice out the used (wind) variables
+        output_upper, output_surface = self.select_variables(
+            output_upper, output_surface
+        )
+
+        # Crop to the region of interest (with halo) before any further copy
+        if self.roi:
+            output_upper = utils_data.cropRoi(output_upper, self.halo)
+            output_surface = utils_data.cropRoi(output_surface, self.halo)
 
         # Reshape output_upper from [1, 2, 13, 721, 1440] to [1, 26, 721, 1440]
         batch_size = output_upper.size(0)  # Extract the batch size
@@ -1292,16 +1555,99 @@ class PowerConv(nn.Module):
         concatenated_output = torch.cat([output_upper, output_surface], dim=1)
 
         # Apply the sequential layers
-        output = self.conv_layers(concatenated_output)
+        if self.roi:
+            output = self._forward_roi(concatenated_output)
+        else:
+            output = self.conv_layers(concatenated_output)
 
-        # Apply clipped ReLU
-        output = clipped_relu(output)
+        # Apply clipped ReLU, fused layers end with the last convolution and ReLU and clamp are a single clamp
+        if self.fused:
+            output = torch.clamp(output.float(), min=0, max=1)
+        else:
+            output = clipped_relu(output)
 
         return output
 
+    def fuse(self):
+        """Fuses the layers for inference: folds each BatchNorm (with its running statistics) into the preceding
+        convolution and merges the last ReLU into the final clamp. The module must be in eval mode, it can not be
+        trained or loaded/saved with the state dict of the unfused module afterwards.
+
+        Returns
+        -------
+        PowerConv
+            The fused module (self).
+        """
+        assert not self.training, "PowerConv can only be fused in eval mode"
+        if self.fused:
+            return self
+
+        fused_layers = []
+        for layer in self.conv_layers:
+            if isinstance(layer, nn.BatchNorm2d):
+                fused_layers[-1] = fuse_conv_bn_eval(fused_layers[-1], layer)
+            elif isinstance(layer, nn.ReLU):
+                # Convolution outputs are not needed afterwards
+                fused_layers.append(nn.ReLU(inplace=True))
+            else:
+                fused_layers.append(layer)
+
+        # relu(clamp(x, 0, 1)) is clamp(x, 0, 1)
+        if isinstance(fused_layers[-1], nn.ReLU):
+            fused_layers.pop()
+
+        self.conv_layers = nn.Sequential(*fused_layers)
+        self.fused = True
+        return self
+
+    def _forward_roi(self, x):
+        """Applies the layers to the cropped region of interest, [1, 28, 185 + 2 * halo, 271 + 2 * halo] -> [1, 1, 185, 271].
+        The halo (circular across the dateline) replaces the padding of the convolutions.
+        Note: in training mode, BatchNorm uses the statistics of the region instead of the whole grid.
+        """
+        for layer in self.conv_layers:
+            if isinstance(layer, nn.Conv2d):
+                # Same convolution without padding, shrinks the field by its padding on each side
+                x = F.conv2d(x, layer.weight, layer.bias, layer.stride)
+            else:
+                x = layer(x)
+        return x
+
+
+def fuse_power_conv(model):
+    """Fuses all PowerConv modules of a model for inference (see PowerConv.fuse), the model must be in eval mode"""
+    for module in model.modules():
+        if isinstance(module, PowerConv):
+            module.fuse()
+    return model
+
+
+def _recover_level(x, Z, H, W, level, weight, bias):
+    """Recovers the pixels of one token level of x [1, 521280, 384] with a kernel size 1 convolution (weight
+    [16, 384, 1], bias [16]) whose output channels are the 4 x 4 pixels of a patch, i.e. the rows of a patch
+    recovery convolution that survive the final slice of a head. Returns [1, 1, 721, 1440] (padding removed).
+    Only the tokens of the level are projected, no other levels or output channels are materialized.
+    """
+    B = x.shape[0]
+
+    # Tokens are ordered (Z, H, W), select the level
+    x = x.view(B, Z, H, W, x.shape[-1])[:, level]  # [1, 181, 360, 384]
+
+    # Kernel size 1 convolution on the tokens of the level, [1, 181, 360, 16]
+    output = F.linear(x, weight.squeeze(-1), bias)
+
+    # Recover the pixels of the patches, output channel c is pixel (c // 4, c % 4) of its patch
+    output = output.view(B, H, W, 4, 4)  # [1, 181, 360, 4, 4]
+    output = torch.permute(output, (0, 1, 3, 2, 4))  # [1, 181, 4, 360, 4]
+    output = output.reshape(B, 1, H * 4, W * 4)  # [1, 1, 724, 1440]
+
+    # Remove padding
+    return output[:, :, : H * 4 - 3, :]  # [1, 1, 721, 1440]
+
 
 def clipped_relu(x):
-    return torch.clamp(F.relu(x), min=0, max=1)
+    # Power outputs are always returned in fp32 (also under autocast)
+    return torch.clamp(F.relu(x.float()), min=0, max=1)
 
 
 def main():
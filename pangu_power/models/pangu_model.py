@@ -46,7 +46,6 @@ class PanguModel(nn.Module):
                     sum(depths[:i_layer]) : sum(depths[: i_layer + 1])
                 ],
                 heads=num_heads[i_layer],
-                use_checkpoint=self.training,
                 device=self.device,
             )
         self.layers = nn.Sequential(layer_list)
@@ -71,46 +70,100 @@ class PanguModel(nn.Module):
             if m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
-    def forward(self, input, input_surface, statistics, maps, const_h):
-        """Backbone architecture"""
+    def _stage_order(self):
+        """Modules of the frozen forward pass (forward_frozen) in execution order"""
+        return [
+            self._input_layer,
+            self.layers[0],
+            self.downsample,
+            self.layers[1],
+            self.layers[2],
+            self.upsample,
+            self.layers[3],
+        ]
+
+    def trainable_frontier(self):
+        """Index (in _stage_order) of the first stage with trainable parameters, len(_stage_order()) if all are frozen"""
+        stages = self._stage_order()
+        for i, stage in enumerate(stages):
+            if any(p.requires_grad for p in stage.parameters()):
+                return i
+        return len(stages)
+
+    def _stage_grad(self, stage, frontier):
+        """Disables gradients for the stages before the trainable frontier, no autograd graph is built through them"""
+        return torch.set_grad_enabled(torch.is_grad_enabled() and stage >= frontier)
+
+    def forward_features(self, input, input_surface, statistics, maps, const_h):
+        """Backbone architecture, returns the tokens before the output layer"""
+        frontier = self.trainable_frontier()
+
         # Embed the input fields into patches
         # input:(B, N, Z, H, W) ([1, 5, 13, 721, 1440])input_surface(B,N,H,W)([1, 4, 721, 1440])
         # x = checkpoint.checkpoint(self._input_layer, input, input_surface)
-        x = self._input_layer(
-            input, input_surface, statistics, maps, const_h
-        )  # ([1, 521280, 192]) [B, spatial, C]
+        with self._stage_grad(0, frontier):
+            x = self._input_layer(
+                input, input_surface, statistics, maps, const_h
+            )  # ([1, 521280, 192]) [B, spatial, C]
 
         # Encoder, composed of two layers
         # Layer 1, shape (8, 360, 181, C), C = 192 as in the original paper
-
-        x = self.layers[0](x, 8, 181, 360)
+        with self._stage_grad(1, frontier):
+            x = self.layers[0](x, 8, 181, 360)
 
         # Store the tensor for skip-connection
         skip = x
 
         # Downsample from (8, 360, 181) to (8, 180, 91)
-        x = self.downsample(x, 8, 181, 360)
+        with self._stage_grad(2, frontier):
+            x = self.downsample(x, 8, 181, 360)
 
-        x = self.layers[1](x, 8, 91, 180)
+        with self._stage_grad(3, frontier):
+            x = self.layers[1](x, 8, 91, 180)
         # Decoder, composed of two layers
         # Layer 3, shape (8, 180, 91, 2C), C = 192 as in the original paper
-        x = self.layers[2](x, 8, 91, 180)
+        with self._stage_grad(4, frontier):
+            x = self.layers[2](x, 8, 91, 180)
 
         # Upsample from (8, 180, 91) to (8, 360, 181)
-        x = self.upsample(x)
+        with self._stage_grad(5, frontier):
+            x = self.upsample(x, 8, 91, 180)
 
         # Layer 4, shape (8, 360, 181, 2C), C = 192 as in the original paper
-        x = self.layers[3](x, 8, 181, 360)  # ([1, 521280, 192])
+        with self._stage_grad(6, frontier):
+            x = self.layers[3](x, 8, 181, 360)  # ([1, 521280, 192])
 
         # Skip connect, in last dimension(C from 192 to 384)
-        x = torch.cat((skip, x), dim=-1)
+        x = torch.cat((skip, x), dim=-1)  # ([1, 521280, 384])
+
+        return x
+
+    def forward_frozen(self, input, input_surface, statistics, maps, const_h):
+        """Part of the forward pass that is frozen during finetuning. Its outputs can be cached (see feature_cache)"""
+        return (self.forward_features(input, input_surface, statistics, maps, const_h),)
 
+    def head_features(self, *features):
+        """Outputs of forward_frozen that forward_trainable uses, these are stored in the feature cache"""
+        return features
+
+    def forward_trainable(self, x):
+        """Part of the forward pass that is trained, takes the outputs of forward_frozen"""
         # Recover the output fields from patches
         # output, output_surface = checkpoint.checkpoint(self._output_layer, x, 8, 181, 360)
         output, output_surface = self._output_layer(x, 8, 181, 360)
 
         return output, output_surface
 
+    def forward(
+        self, input, input_surface, statistics, maps, const_h, cached_features=None
+    ):
+        """Backbone architecture. If cached_features (outputs of forward_frozen) are given, only the trainable part is run"""
+        if cached_features is None:
+            cached_features = self.forward_frozen(
+                input, input_surface, statistics, maps, const_h
+            )
+        return self.forward_trainable(*cached_features)
+
 
 if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
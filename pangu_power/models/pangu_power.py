@@ -36,47 +36,8 @@ class PanguPowerPatchRecovery(PanguModel):
         # Replace the output layer with new PatchRecovery
         self._output_power_layer = PatchRecoveryPowerAllWithClippedReLU(dims[-2])
 
-    def forward(
-        self,
-        input: torch.Tensor,
-        input_surface: torch.Tensor,
-        statistics: torch.Tensor,
-        maps: torch.Tensor,
-        const_h: torch.Tensor,
-    ) -> torch.Tensor:
+    def forward_trainable(self, x: torch.Tensor) -> torch.Tensor:
         """Same forward pass as PanguModel, replaces the output layer"""
-        # Embed the input fields into patches
-        # input:(B, N, Z, H, W) ([1, 5, 13, 721, 1440])input_surface(B,N,H,W)([1, 4, 721, 1440])
-        # x = checkpoint.checkpoint(self._input_layer, input, input_surface)
-        x = self._input_layer(
-            input, input_surface, statistics, maps, const_h
-        )  # ([1, 521280, 192]) [B, spatial, C]
-
-        # Encoder, composed of two layers
-        # Layer 1, shape (8, 360, 181, C), C = 192 as in the original paper
-
-        x = self.layers[0](x, 8, 181, 360)
-
-        # Store the tensor for skip-connection
-        skip = x
-
-        # Downsample from (8, 360, 181) to (8, 180, 91)
-        x = self.downsample(x, 8, 181, 360)
-
-        x = self.layers[1](x, 8, 91, 180)
-        # Decoder, composed of two layers
-        # Layer 3, shape (8, 180, 91, 2C), C = 192 as in the original paper
-        x = self.layers[2](x, 8, 91, 180)
-
-        # Upsample from (8, 180, 91) to (8, 360, 181)
-        x = self.upsample(x)
-
-        # Layer 4, shape (8, 360, 181, 2C), C = 192 as in the original paper
-        x = self.layers[3](x, 8, 181, 360)  # ([1, 521280, 192])
-
-        # Skip connect, in last dimension(C from 192 to 384)
-        x = torch.cat((skip, x), dim=-1)
-
         # Recover the output fields from patches
         output = self._output_power_layer(x, 8, 181, 360)
 
@@ -125,47 +86,41 @@ class PanguPowerConv(PanguModel):
         # Re-Init weights
         super(PanguPowerConv, self).apply(self._init_weights)
 
-    def forward(self, input, input_surface, statistics, maps, const_h):
-        """Same forward pass as PanguModel, but adds a new output layer"""
-        # Embed the input fields into patches
-        # input:(B, N, Z, H, W) ([1, 5, 13, 721, 1440])input_surface(B,N,H,W)([1, 4, 721, 1440])
-        # x = checkpoint.checkpoint(self._input_layer, input, input_surface)
-        x = self._input_layer(
-            input, input_surface, statistics, maps, const_h
-        )  # ([1, 521280, 192]) [B, spatial, C]
-
-        # Encoder, composed of two layers
-        # Layer 1, shape (8, 360, 181, C), C = 192 as in the original paper
-
-        x = self.layers[0](x, 8, 181, 360)
-
-        # Store the tensor for skip-connection
-        skip = x
-
-        # Downsample from (8, 360, 181) to (8, 180, 91)
-        x = self.downsample(x, 8, 181, 360)
-
-        x = self.layers[1](x, 8, 91, 180)
-        # Decoder, composed of two layers
-        # Layer 3, shape (8, 180, 91, 2C), C = 192 as in the original paper
-        x = self.layers[2](x, 8, 91, 180)
+    def forward_frozen(
+        self,
+        input: torch.Tensor,
+        input_surface: torch.Tensor,
+        statistics: torch.Tensor,
+        maps: torch.Tensor,
+        const_h: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same forward pass as PanguModel, the pangu output (upper and surface) is frozen"""
+        x = self.forward_features(input, input_surface, statistics, maps, const_h)
 
-        # Upsample from (8, 180, 91) to (8, 360, 181)
-        x = self.upsample(x)
+        # Recover the output fields from patches
+        # output, output_surface = checkpoint.checkpoint(self._output_layer, x, 8, 181, 360)
+        stages = self._stage_order()
+        with self._stage_grad(len(stages) - 1, self.trainable_frontier()):
+            output_upper, output_surface = self._output_layer(x, 8, 181, 360)
 
-        # Layer 4, shape (8, 360, 181, 2C), C = 192 as in the original paper
-        x = self.layers[3](x, 8, 181, 360)  # ([1, 521280, 192])
+        return output_upper, output_surface
 
-        # Skip connect, in last dimension(C from 192 to 384)
-        x = torch.cat((skip, x), dim=-1)
+    def head_features(
+        self, output_upper: torch.Tensor, output_surface: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Only the variables of the power head are cached (see PowerConv.select_variables)"""
+        return self._conv_power_layers.select_variables(output_upper, output_surface)
 
-        # Recover the output fields from patches
-        # output, output_surface = checkpoint.checkpoint(self._output_layer, x, 8, 181, 360)
-        output_upper, output_surface = self._output_layer(x, 8, 181, 360)
+    def _stage_order(self) -> List[torch.nn.Module]:
+        """The pangu output layer is part of the frozen forward pass"""
+        return super(PanguPowerConv, self)._stage_order() + [self._output_layer]
 
+    def forward_trainable(
+        self, output_upper: torch.Tensor, output_surface: torch.Tensor
+    ) -> torch.Tensor:
+        """Adds a new output layer to the pangu output"""
         output_power = self._conv_power_layers(output_upper, output_surface)
 
-        # Return output_surface for visualization purposes only
         return output_power
 
     def load_pangu_state_dict(self, device: torch.device) -> None:
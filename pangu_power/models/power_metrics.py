@@ -0,0 +1,174 @@
+# Streaming power scores of the test runs: per sample scores and per grid point error maps are accumulated on the
+# device and only copied to the host at the end (or every cfg.PG.TEST.METRIC_SYNC_INTERVAL batches).
+
+import os
+from typing import Dict, List, Sequence
+import torch
+import torch.distributed as dist
+
+from ..era5_data import utils, utils_data
+from ..era5_data.config import cfg
+
+
+class PowerScoreAccumulator:
+    """
+    Accumulates RMSE, MAE, ACC and bias of every test sample and the per grid point bias, MAE and RMSE over all
+    samples, on the sea points of the grid.
+
+    The scores are computed per sample like score.rmse and score.mae, the ACC is the unweighted ACC of the anomalies
+    to the mean power per grid point (see score.weighted_acc), the mean scores are the means over the samples.
+    """
+
+    SCORES = ("rmse", "mae", "acc", "bias")
+
+    def __init__(
+        self,
+        sea_indices: torch.Tensor,
+        mean_power_per_grid_point: torch.Tensor,
+        sync_interval: int = cfg.PG.TEST.METRIC_SYNC_INTERVAL,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        sea_indices : torch.Tensor
+            Flat grid indices of the sea points (see utils_data.getSeaIndices).
+        mean_power_per_grid_point : torch.Tensor
+            The mean power per grid point, [721, 1440].
+        sync_interval : int, optional
+            Number of updates after which the per sample scores are copied to the host, 0 only copies them when they
+            are read. By default cfg.PG.TEST.METRIC_SYNC_INTERVAL
+        """
+        self.sea_indices = sea_indices
+        self.mean_power = utils_data.gatherGridPoints(
+            mean_power_per_grid_point, sea_indices
+        )
+        self.sync_interval = sync_interval
+
+        # Per grid point sums of the errors (output - target), their absolute values and their squares
+        self.error_sums = torch.zeros(
+            3, len(sea_indices), dtype=torch.float64, device=sea_indices.device
+        )
+        self.count = 0
+
+        # Per sample scores on the host {score: {target time: value}}, and those not yet copied ([B, 4] each)
+        self.scores: Dict[str, Dict[str, float]] = {name: {} for name in self.SCORES}
+        self._pending: List[torch.Tensor] = []
+        self._pending_times: List[str] = []
+        self._updates = 0
+
+    @torch.no_grad()
+    def update(
+        self,
+        output_power: torch.Tensor,
+        target_power: torch.Tensor,
+        target_times: Sequence[str],
+    ) -> None:
+        """
+        Adds the scores of a batch, without synchronizing with the host.
+
+        Parameters
+        ----------
+        output_power : torch.Tensor
+            The predicted power of the batch on the [721, 1440] grid, [B, (1,) 721, 1440].
+        target_power : torch.Tensor
+            The actual power of the batch, same shape.
+        target_times : Sequence[str]
+            The target time of every sample of the batch.
+        """
+        batch_size = len(target_times)
+        output = output_power.reshape(batch_size, -1).float()
+        output = output.index_select(1, self.sea_indices)
+        target = target_power.reshape(batch_size, -1).float()
+        target = target.index_select(1, self.sea_indices)
+
+        error = output - target
+        output_anomaly = output - self.mean_power
+        target_anomaly = target - self.mean_power
+        acc = (output_anomaly * target_anomaly).sum(-1) / torch.sqrt(
+            output_anomaly.square().sum(-1) * target_anomaly.square().sum(-1)
+        )
+        self._pending.append(
+            torch.stack(
+                (
+                    error.square().mean(-1).sqrt(),
+                    error.abs().mean(-1),
+                    acc,
+                    error.mean(-1),
+                ),
+                dim=-1,
+            )
+        )
+        self._pending_times.extend(target_times)
+
+        error = error.double()
+        self.error_sums[0] += error.sum(0)
+        self.error_sums[1] += error.abs().sum(0)
+        self.error_sums[2] += error.square().sum(0)
+        self.count += batch_size
+
+        self._updates += 1
+        if self.sync_interval > 0 and self._updates % self.sync_interval == 0:
+            self.sync()
+
+    def sync(self) -> None:
+        """Copies the pending per sample scores to the host (one device synchronization)."""
+        if not self._pending:
+            return
+        values = torch.cat(self._pending).cpu().tolist()
+        for target_time, sample_scores in zip(self._pending_times, values):
+            for name, value in zip(self.SCORES, sample_scores):
+                self.scores[name][target_time] = value
+        self._pending.clear()
+        self._pending_times.clear()
+
+    def all_reduce(self) -> None:
+        """Merges the scores of all ranks (if torch.distributed is initialized), call once on every rank."""
+        self.sync()
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+
+        dist.all_reduce(self.error_sums)
+        count = torch.tensor(self.count, device=self.error_sums.device)
+        dist.all_reduce(count)
+        self.count = int(count.item())
+
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, self.scores)
+        for rank_scores in gathered:
+            for name in self.SCORES:
+                self.scores[name].update(rank_scores[name])
+
+    def mean_scores(self) -> Dict[str, float]:
+        """Returns the mean of every score over the samples (NaN without samples)."""
+        self.sync()
+        return {
+            name: sum(values.values()) / len(values) if values else float("nan")
+            for name, values in self.scores.items()
+        }
+
+    def error_maps(self) -> Dict[str, torch.Tensor]:
+        """Returns the bias, MAE and RMSE per grid point over all samples, [721, 1440] each (NaN on land, and
+        everywhere without samples)."""
+        if self.count > 0:
+            means = self.error_sums / self.count
+        else:
+            means = torch.full_like(self.error_sums, float("nan"))
+        maps = {"bias": means[0], "mae": means[1], "rmse": means[2].sqrt()}
+        for name, values in maps.items():
+            grid = torch.full(
+                (721 * 1440,), float("nan"), device=values.device, dtype=torch.float32
+            )
+            grid[self.sea_indices] = values.float()
+            maps[name] = grid.view(721, 1440)
+        return maps
+
+    def save(self, csv_path: str) -> None:
+        """Saves the per sample scores (<score>_power.csv) and the error maps (error_maps.pth) to csv_path."""
+        self.sync()
+        utils.mkdirs(csv_path)
+        for name, values in self.scores.items():
+            utils.save_error_power(csv_path, values, name)
+        torch.save(
+            {name: grid.cpu() for name, grid in self.error_maps().items()},
+            os.path.join(csv_path, "error_maps.pth"),
+        )
@@ -1,104 +1,45 @@
 import os
+import time
 from datetime import datetime
 import warnings
 import logging
 import torch
 from torch import nn
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from ..era5_data import utils, utils_data, score
+from ..era5_data import utils, utils_data
+from ..era5_data.config import cfg
 from ..models.train_power import (
     model_inference_power,
     model_inference_pangu,
     baseline_inference,
     load_land_sea_mask,
+    load_missing_era5,
     visualize,
 )
 from ..models.baseline_formula import BaselineFormula
+from ..models.layers import fuse_power_conv
+from ..models.power_metrics import PowerScoreAccumulator
 
 
-warnings.filterwarnings(
-    "ignore",
-    message="None of the inputs have requires_grad=True. Gradients will be None",
-)
-
 warnings.filterwarnings(
     "ignore",
     message="Attempting to use hipBLASLt on an unsupported architecture! Overriding blas backend to hipblas",
 )
 
 
-def calculate_scores(
-    output_power: torch.Tensor,
-    target_power: torch.Tensor,
-    lsm_expanded: torch.Tensor,
-    mean_power_per_grid_point: torch.Tensor,
-    target_time: str,
-) -> Tuple[str, Dict[str, float]]:
-    """
-    Calculates RMSE, MAE, and ACC scores for power predictions.
-
-    Parameters
-    ----------
-    output_power : torch.Tensor
-        The predicted power output.
-    target_power : torch.Tensor
-        The actual power output.
-    lsm_expanded : torch.Tensor
-        The land-sea mask.
-    mean_power_per_grid_point : torch.Tensor
-        The mean power per grid point.
-    target_time : str
-        The target time for the prediction.
-
-    Returns
-    -------
-    Tuple[str, Dict[str, float]]
-        The target time and a dictionary containing the RMSE, MAE, and ACC scores.
-    """
-    scores = {}
-
-    # Mask outputs and targets
-    output_power_masked = output_power[lsm_expanded.squeeze() == 1]
-    target_power_masked = target_power[lsm_expanded.squeeze() == 1]
-
-    # RMSE
-    scores["rmse"] = (
-        (score.rmse(output_power_masked, target_power_masked)).detach().cpu().numpy()
+def load_pangu_outputs(
+    steps: List[str], device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Loads the stored pangu forecasts (see utils.load_pangu_output) of a batch of target steps onto a device"""
+    outputs = [utils.load_pangu_output(step) for step in steps]
+    output_upper = torch.cat(
+        [upper.reshape(1, *upper.shape[-4:]) for upper, _ in outputs]
     )
-
-    # Mean absolute error (MAE)
-    scores["mae"] = (
-        (score.mae(output_power_masked, target_power_masked)).detach().cpu().numpy()
+    output_surface = torch.cat(
+        [surface.reshape(1, *surface.shape[-3:]) for _, surface in outputs]
     )
-
-    # Calculate power anomalies
-    output_power_anomaly = output_power - mean_power_per_grid_point
-    target_power_anomaly = target_power - mean_power_per_grid_point
-
-    # Mask anomalies
-    output_power_anomaly_masked = output_power_anomaly.squeeze(0)[
-        lsm_expanded.squeeze() == 1
-    ]
-    target_power_anomaly_masked = target_power_anomaly.squeeze(0)[
-        lsm_expanded.squeeze() == 1
-    ]
-
-    # ACC
-    scores["acc"] = (
-        (
-            score.weighted_acc(
-                output_power_anomaly_masked.detach().cpu(),
-                target_power_anomaly_masked.detach().cpu(),
-                weighted=False,
-            )
-        )
-        .detach()
-        .cpu()
-        .numpy()
-    )
-
-    return target_time, scores
+    return output_upper.to(device), output_surface.to(device)
 
 
 def test(
@@ -107,10 +48,13 @@ def test(
     device: torch.device,
     res_path: str,
     logger: logging.Logger,
-) -> None:
+) -> Dict[str, float]:
     """
     Test the model on the test dataset and calculate RMSE, MAE, and ACC scores.
 
+    Also logs the inference time per step and the peak GPU memory at the configured precision
+    (cfg.PG.PRECISION), so that the precisions can be compared.
+
     Parameters
     ----------
     test_loader : torch.utils.data.DataLoader
@@ -126,15 +70,25 @@ def test(
 
     Returns
     -------
-    None
+    Dict[str, float]
+        The mean RMSE, MAE, and ACC scores.
     """
-    rmse_power = dict()
-    mae_power = dict()
-    acc_power = dict()
+    inference_time = 0.0
+    num_samples = 0
+
+    aux_constants = utils_data.getAllConstants(device=device)
+    metrics = PowerScoreAccumulator(
+        utils_data.getSeaIndices(device), utils_data.getMeanPower(device)
+    )
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
 
-    aux_constants = utils_data.loadAllConstants(device=device)
+    # Inference only: BatchNorms of the power layers are folded into their convolutions
+    model.eval()
+    fuse_power_conv(model)
 
-    for id, data in enumerate(test_loader, 0):
+    prefetcher = utils_data.DataPrefetcher(test_loader, device, indices=(0, 1, 3))
+    for id, data in enumerate(prefetcher, 0):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] predict on {id}")
         (
@@ -147,86 +101,88 @@ def test(
             periods_test,
         ) = data
 
-        input_upper_test, input_surface_test, target_power_test = (
-            input_upper_test.to(device),
-            input_surface_test.to(device),
-            target_power_test.to(device),
-        )
         model.eval()
 
-        # Inference
+        # Inference (synchronized, so that the time is not only the kernel launches)
+        start = time.perf_counter()
         output_power_test = model_inference_power(
             model, input_upper_test, input_surface_test, aux_constants
         )
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        inference_time += time.perf_counter() - start
+        num_samples += len(periods_test[1])
+        # Full maps are needed for visualization (ROI outputs are scattered back)
+        output_power_test = utils_data.toGlobalGrid(output_power_test)
 
         # Apply lsm
         lsm_expanded = load_land_sea_mask(output_power_test.device, fill_value=0)
         output_power_test = output_power_test * lsm_expanded
 
         # Visualize
-        target_time = periods_test[1][0]
-        png_path = os.path.join(res_path, "png")
-        utils.mkdirs(png_path)
-        visualize(
-            output_power_test,
-            target_power_test,
-            input_surface_test,
-            input_upper_test,
-            target_surface_test,
-            target_upper_test,
-            target_time,
-            png_path,
-        )
-
-        # Compute test scores
-        output_power_test = output_power_test.squeeze()
-        target_power_test = target_power_test.squeeze()
-        mean_power_per_grid_point = utils_data.loadMeanPower(output_power_test.device)
-
-        # Calculate scores using the helper function
-        target_time, scores = calculate_scores(
-            output_power_test,
-            target_power_test,
-            lsm_expanded,
-            mean_power_per_grid_point,
-            target_time,
-        )
+        if cfg.PG.TEST.VISUALIZE:
+            target_time = periods_test[1][0]
+            png_path = os.path.join(res_path, "png")
+            utils.mkdirs(png_path)
+            target_upper_test, target_surface_test = load_missing_era5(
+                test_loader, target_upper_test, target_surface_test, target_time
+            )
+            visualize(
+                output_power_test,
+                target_power_test,
+                input_surface_test,
+                input_upper_test,
+                target_surface_test,
+                target_upper_test,
+                target_time,
+                png_path,
+            )
 
-        # Update score dictionaries
-        rmse_power[target_time] = scores["rmse"]
-        mae_power[target_time] = scores["mae"]
-        acc_power[target_time] = scores["acc"]
+        # Accumulate the test scores of the batch on the device
+        metrics.update(output_power_test, target_power_test, periods_test[1])
 
-    # Save scores to csv
-    csv_path = os.path.join(res_path, "csv")
-    utils.mkdirs(csv_path)
-    utils.save_error_power(csv_path, rmse_power, "rmse")
-    utils.save_error_power(csv_path, mae_power, "mae")
-    utils.save_error_power(csv_path, acc_power, "acc")
+    # Save scores to csv, and the per grid point error maps
+    metrics.all_reduce()
+    metrics.save(os.path.join(res_path, "csv"))
 
     # Print mean scores
+    mean_scores = metrics.mean_scores()
     logger.info(f"{res_path.split('/')[-2]} model scores:")
-    logger.info(f"RMSE: {(sum(rmse_power.values()) / len(rmse_power)):.4f}")
-    logger.info(f"MAE: {(sum(mae_power.values()) / len(mae_power)):.4f}")
-    logger.info(f"ACC: {(sum(acc_power.values()) / len(acc_power)):.4f}")
+    logger.info(f"RMSE: {mean_scores['rmse']:.4f}")
+    logger.info(f"MAE: {mean_scores['mae']:.4f}")
+    logger.info(f"ACC: {mean_scores['acc']:.4f}")
+    logger.info(f"Bias: {mean_scores['bias']:.4f}")
+
+    # Print performance at the configured precision
+    logger.info(f"Precision: {cfg.PG.PRECISION}")
+    # Per sample of this process (an empty test loader has no inference time)
+    if num_samples > 0:
+        logger.info(f"Inference time per step: {inference_time / num_samples:.4f}s")
+    if device.type == "cuda":
+        peak_memory = torch.cuda.max_memory_allocated(device) / 1024**3
+        logger.info(f"Peak GPU memory: {peak_memory:.2f} GiB")
+
+    return mean_scores
 
 
 def test_baseline(
     test_loader: torch.utils.data.DataLoader,
-    pangu_model: nn.Module,
+    pangu_model: Optional[nn.Module],
     device: torch.device,
     res_path: str,
     baseline_type: str,
 ) -> None:
     """
     Test the baseline model on the test dataset and calculate RMSE, MAE, and ACC scores.
+    The formula baseline is also scored on every pressure level, the surface and the hub heights (csv/levels).
 
     Parameters
     ----------
     test_loader : torch.utils.data.DataLoader
         DataLoader for the test dataset.
-    pangu_model : nn.Module
-        The Pangu model used for generating baseline predictions.
+    pangu_model : Optional[nn.Module]
+        The Pangu model used for generating baseline predictions. If None, the formula baseline uses the stored
+        pangu forecasts (see cfg.PG.TEST.STORED_PANGU_OUTPUTS).
     device : torch.device
         Device to run the testing on.
     res_path : str
@@ -238,13 +194,25 @@ def test_baseline(
     -------
     None
     """
-    rmse_power = dict()
-    mae_power = dict()
-    acc_power = dict()
+    metrics = PowerScoreAccumulator(
+        utils_data.getSeaIndices(device), utils_data.getMeanPower(device)
+    )
 
     baseline_formula = BaselineFormula(device).to(device)
 
-    for id, data in enumerate(test_loader, 0):
+    # Scores of the formula baseline on every pressure level, the surface and the hub heights (see
+    # BaselineFormula.forward_all), the main scores are those of baseline_inference (1000hPa)
+    level_metrics = {}
+    if baseline_type == "formula":
+        level_metrics = {
+            name: PowerScoreAccumulator(
+                utils_data.getSeaIndices(device), utils_data.getMeanPower(device)
+            )
+            for name in baseline_formula.level_names()
+        }
+
+    prefetcher = utils_data.DataPrefetcher(test_loader, device, indices=(0, 1, 2, 3))
+    for id, data in enumerate(prefetcher, 0):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] predict on {id}")
         (
@@ -257,24 +225,32 @@ def test_baseline(
             periods_test,
         ) = data
 
-        input_test, input_power_test, input_surface_test, target_power_test = (
-            input_test.to(device),
-            input_power_test.to(device),
-            input_surface_test.to(device),
-            target_power_test.to(device),
-        )
-
         # Inference
-        mean_power = utils_data.loadMeanPower(device)
+        mean_power = utils_data.getMeanPower(device)
 
         # Pangu forecasts output is required for formula baseline, therefore we need to run the model
         if baseline_type == "formula":
-            pangu_model.eval()
-            # Inference
-            aux_constants = utils_data.loadAllConstants(device=device)
-            output_weather_upper, output_weather_surface = model_inference_pangu(
-                pangu_model, input_test, input_surface_test, aux_constants
-            )
+            if pangu_model is None:
+                # Or read the stored forecasts of the batch
+                output_weather_upper, output_weather_surface = load_pangu_outputs(
+                    periods_test[1], device
+                )
+            else:
+                pangu_model.eval()
+                # Inference
+                aux_constants = utils_data.getAllConstants(device=device)
+                output_weather_upper, output_weather_surface = model_inference_pangu(
+                    pangu_model, input_test, input_surface_test, aux_constants
+                )
+
+            # All levels in one pass, [B, 13 + 1 + len(cfg.POWER.HUB_HEIGHTS), 721, 1440]
+            output_power_levels = baseline_formula.forward_all(
+                output_weather_upper, output_weather_surface
+            ) * load_land_sea_mask(device, fill_value=0)
+            for i, metrics_level in enumerate(level_metrics.values()):
+                metrics_level.update(
+                    output_power_levels[:, i], target_power_test, periods_test[1]
+                )
 
             # Inference
             output_power_test = baseline_inference(
@@ -294,49 +270,38 @@ def test_baseline(
         lsm_expanded = load_land_sea_mask(output_power_test.device, fill_value=0)
         output_power_test = output_power_test * lsm_expanded
 
-        # Visualize
-        target_time = periods_test[1][0]
-        png_path = os.path.join(res_path, "png")
-
         # This can be used to pre-generate pangu outputs, which are required for some visualizations
-        # save_output_pth(output_weather_upper, output_weather_surface, target_time, res_path)
-
-        # If the above is uncommented, the visualization must be commented out
-        utils.mkdirs(png_path)
-        visualize(
-            output_power_test,
-            target_power_test,
-            input_surface_test,
-            input_test,
-            target_surface_test,
-            target_upper_test,
-            target_time,
-            png_path,
-            input_power=input_power_test,
-        )
-
-        # Compute test scores
-        output_power_test = output_power_test.squeeze()
-        target_power_test = target_power_test.squeeze()
-        mean_power_per_grid_point = utils_data.loadMeanPower(output_power_test.device)
+        # save_output_pth(output_weather_upper, output_weather_surface, periods_test[1][0], res_path)
+
+        # Visualize (cfg.PG.TEST.VISUALIZE must be False while pre-generating the pangu outputs)
+        if cfg.PG.TEST.VISUALIZE:
+            target_time = periods_test[1][0]
+            png_path = os.path.join(res_path, "png")
+            utils.mkdirs(png_path)
+            input_test, input_surface_test = load_missing_era5(
+                test_loader, input_test, input_surface_test, periods_test[0][0]
+            )
+            target_upper_test, target_surface_test = load_missing_era5(
+                test_loader, target_upper_test, target_surface_test, target_time
+            )
+            visualize(
+                output_power_test,
+                target_power_test,
+                input_surface_test,
+                input_test,
+                target_surface_test,
+                target_upper_test,
+                target_time,
+                png_path,
+                input_power=input_power_test,
+            )
 
-        # Calculate scores using the helper function
-        target_time, scores = calculate_scores(
-            output_power_test,
-            target_power_test,
-            lsm_expanded,
-            mean_power_per_grid_point,
-            target_time,
-        )
+        # Accumulate the test scores of the batch on the device
+        metrics.update(output_power_test, target_power_test, periods_test[1])
 
-        # Update score dictionaries
-        rmse_power[target_time] = scores["rmse"]
-        mae_power[target_time] = scores["mae"]
-        acc_power[target_time] = scores["acc"]
-
-    # Save scores to csv
-    csv_path = os.path.join(res_path, "csv")
-    utils.mkdirs(csv_path)
-    utils.save_error_power(csv_path, rmse_power, "rmse")
-    utils.save_error_power(csv_path, mae_power, "mae")
-    utils.save_error_power(csv_path, acc_power, "acc")
+    # Save scores to csv, and the per grid point error maps
+    metrics.all_reduce()
+    metrics.save(os.path.join(res_path, "csv"))
+    for name, metrics_level in level_metrics.items():
+        metrics_level.all_reduce()
+        metrics_level.save(os.path.join(res_path, "csv", "levels", name))
@@ -1,5 +1,6 @@
 import os
 import copy
+import contextlib
 import torch
 from torch import nn
 import torch.distributed as dist
@@ -13,11 +14,6 @@ from ..era5_data.config import cfg
 from ..models.baseline_formula import BaselineFormula
 
 
-warnings.filterwarnings(
-    "ignore",
-    message="None of the inputs have requires_grad=True. Gradients will be None",
-)
-
 warnings.filterwarnings(
     "ignore",
     message="Attempting to use hipBLASLt on an unsupported architecture! Overriding blas backend to hipblas",
@@ -44,8 +40,37 @@ def load_land_sea_mask(
     torch.Tensor
         The loaded land-sea mask.
     """
-    return utils_data.loadLandSeaMask(
-        device, mask_type=mask_type, fill_value=fill_value
+    # Loaded once per device, later calls return the cached tensor
+    return utils_data.getLandSeaMask(device, mask_type=mask_type, fill_value=fill_value)
+
+
+PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device: torch.device) -> contextlib.AbstractContextManager:
+    """
+    Returns the autocast context of the configured precision (cfg.PG.PRECISION) for a device.
+
+    Parameters
+    ----------
+    device : torch.device
+        The device the model runs on.
+
+    Returns
+    -------
+    contextlib.AbstractContextManager
+        torch.autocast for bf16 and fp16, a no-op context for fp32.
+    """
+    dtype = PRECISION_DTYPES[cfg.PG.PRECISION]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def create_grad_scaler(device: torch.device) -> torch.amp.GradScaler:
+    """Returns a GradScaler, only enabled for fp16 (bf16 and fp32 do not need loss scaling)."""
+    return torch.amp.GradScaler(
+        device.type, enabled=cfg.PG.PRECISION == "fp16" and device.type == "cuda"
     )
 
 
@@ -54,17 +79,27 @@ def model_inference_power(
     input: torch.Tensor,
     input_surface: torch.Tensor,
     aux_constants: Dict[str, torch.Tensor],
+    cached: bool = False,
 ) -> torch.Tensor:
-    """Inference code for power models."""
-    output_power = model(
-        input,
-        input_surface,
-        aux_constants["weather_statistics"],
-        aux_constants["constant_maps"],
-        aux_constants["const_h"],
-    )
+    """Inference code for power models. If cached is True, input contains the cached features of the frozen model part (see feature_cache)."""
+    if cached:
+        with autocast(input[0].device):
+            output_power = model(
+                None, None, None, None, None, cached_features=[f.float() for f in input]
+            )
+        return output_power.float()
+
+    with autocast(input.device):
+        output_power = model(
+            input,
+            input_surface,
+            aux_constants["weather_statistics"],
+            aux_constants["constant_maps"],
+            aux_constants["const_h"],
+        )
 
-    return output_power
+    # Losses and scores are calculated in fp32
+    return output_power.float()
 
 
 def model_inference_pangu(
@@ -74,13 +109,15 @@ def model_inference_pangu(
     aux_constants: Dict[str, torch.Tensor],
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """Inference for the Pangu model. Pangu outputs are normalized."""
-    output_upper, output_surface = model(
-        input,
-        input_surface,
-        aux_constants["weather_statistics"],
-        aux_constants["constant_maps"],
-        aux_constants["const_h"],
-    )
+    with autocast(input.device):
+        output_upper, output_surface = model(
+            input,
+            input_surface,
+            aux_constants["weather_statistics"],
+            aux_constants["constant_maps"],
+            aux_constants["const_h"],
+        )
+    output_upper, output_surface = output_upper.float(), output_surface.float()
 
     # Transfer to the output to the original data range
     output_upper, output_surface = utils_data.normBackData(
@@ -149,10 +186,10 @@ def calculate_loss(
     output: torch.Tensor,
     target: torch.Tensor,
     criterion: nn.Module,
-    lsm_expanded: torch.Tensor,
+    sea_indices: torch.Tensor,
 ) -> torch.Tensor:
     """
-    Calculate the loss for the model output. Applies the land-sea mask to the output and target before calculating the loss.
+    Calculate the loss for the model output. Only the sea points of the land-sea mask are used.
 
     Parameters
     ----------
@@ -162,18 +199,22 @@ def calculate_loss(
         The target values.
     criterion : nn.Module
         The loss criterion.
-    lsm_expanded : torch.Tensor
-        The land-sea mask.
+    sea_indices : torch.Tensor
+        Flat grid indices of the sea points (see utils_data.getSeaIndices), of the ROI for ROI outputs.
 
     Returns
     -------
     torch.Tensor
         The calculated loss.
     """
-    mask_not_zero = ~(lsm_expanded == 0)
-    mask_not_zero = mask_not_zero.unsqueeze(1)
-    output = output * lsm_expanded
-    loss = criterion(output[mask_not_zero], target[mask_not_zero])
+    # ROI outputs (see cfg.POWER.ROI) are compared to the same region of the target
+    if utils_data.isRoi(output) and not utils_data.isRoi(target):
+        target = utils_data.cropRoi(target)
+
+    # Gather the sea points, [B, 1, 721, 1440] -> [B, 1, N]
+    output = utils_data.gatherGridPoints(output, sea_indices)
+    target = utils_data.gatherGridPoints(target, sea_indices)
+    loss = criterion(output, target)
     return torch.mean(loss)
 
 
@@ -189,22 +230,22 @@ def visualize(
     input_power: Optional[torch.Tensor] = None,
     epoch: Optional[int] = None,
 ) -> None:
-    """For documentation, see utils.visuailze_all function"""
+    """For documentation, see utils.visuailze_all function. Batched inputs are visualized for their first sample (step)"""
     if input_power is not None:
-        input_power = input_power.detach().cpu().squeeze()
+        input_power = input_power[0].detach().cpu().squeeze()
 
     # Load pre-generated pangu outputs for visualization
     output_upper, output_surface = utils.load_pangu_output(step)
 
     utils.visualize_all(
-        output_power.detach().cpu().squeeze(),
-        target_power.detach().cpu().squeeze(),
-        input_surface.detach().cpu().squeeze(),
-        input_upper.detach().cpu().squeeze(),
+        output_power[0].detach().cpu().squeeze(),
+        target_power[0].detach().cpu().squeeze(),
+        input_surface[0].detach().cpu().squeeze(),
+        input_upper[0].detach().cpu().squeeze(),
         output_surface.detach().cpu().squeeze(),
         output_upper.detach().cpu().squeeze(),
-        target_surface.detach().cpu().squeeze(),
-        target_upper.detach().cpu().squeeze(),
+        target_surface[0].detach().cpu().squeeze(),
+        target_upper[0].detach().cpu().squeeze(),
         step=step,
         path=path,
         input_power=input_power,
@@ -212,6 +253,38 @@ def visualize(
     )
 
 
+def load_missing_era5(
+    loader: torch.utils.data.DataLoader,
+    upper: Union[torch.Tensor, List[torch.Tensor]],
+    surface: torch.Tensor,
+    step: str,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the ERA5 fields of a step, loading them from the dataset if the batch does not contain them
+    (target fields of datasets created with load_target_era5=False, input fields of cached features).
+
+    Parameters
+    ----------
+    loader : torch.utils.data.DataLoader
+        The data loader the batch was taken from.
+    upper : Union[torch.Tensor, List[torch.Tensor]]
+        The upper-air fields of the batch (empty if not loaded, cached features instead of the input fields).
+    surface : torch.Tensor
+        The surface fields of the batch (empty if not loaded).
+    step : str
+        The time of the fields ("%Y%m%d%H").
+
+    Returns
+    -------
+    Tuple[torch.Tensor, torch.Tensor]
+        The upper-air and surface fields.
+    """
+    if isinstance(upper, torch.Tensor) and upper.numel() > 0 and surface.numel() > 0:
+        return upper, surface
+    upper, surface = loader.dataset.load_era5(step)  # type: ignore
+    return torch.from_numpy(upper).unsqueeze(0), torch.from_numpy(surface).unsqueeze(0)
+
+
 def save_output_pth(
     output_upper: torch.Tensor,
     output_surface: torch.Tensor,
@@ -302,7 +375,8 @@ def train(
     best_loss = float("inf")
     epochs_since_last_improvement = 0
     best_model = model
-    aux_constants = utils_data.loadAllConstants(device=device)
+    aux_constants = utils_data.getAllConstants(device=device)
+    scaler = create_grad_scaler(device)
 
     # Termination flag to signal early stopping
     early_stop_flag = torch.tensor(
@@ -323,6 +397,7 @@ def train(
             rank,
             device,
             i,
+            scaler,
         )
         loss_list.append(epoch_loss)
         lr_scheduler.step()
@@ -388,6 +463,7 @@ def train_one_epoch(
     rank: int,
     device: Union[torch.device, None],
     epoch: int,
+    scaler: Optional[torch.amp.GradScaler] = None,
 ) -> float:
     """
     Trains the model for one epoch.
@@ -412,6 +488,8 @@ def train_one_epoch(
         The device to train on.
     epoch : int
         The current epoch number.
+    scaler : Optional[torch.amp.GradScaler], optional
+        Gradient scaler for fp16 training, by default None (plain backward and optimizer step).
 
     Returns
     -------
@@ -421,7 +499,9 @@ def train_one_epoch(
     epoch_loss = 0.0
     print(f"Starting epoch {epoch}/{cfg.PG.TRAIN.EPOCHS}")
 
-    for id, train_data in enumerate(train_loader):
+    # Inputs and power targets are copied to the device while the previous batch is processed
+    prefetcher = utils_data.DataPrefetcher(train_loader, device, indices=(0, 1, 3))
+    for id, train_data in enumerate(prefetcher):
         (
             input,
             input_surface,
@@ -431,26 +511,35 @@ def train_one_epoch(
             target_surface,
             periods,
         ) = train_data
-        input, input_surface, target_power = (
-            input.to(device),
-            input_surface.to(device),
-            target_power.to(device),
-        )
         print(f"(T) Processing batch {id + 1}/{len(train_loader)}")
 
         optimizer.zero_grad()
         model.train()
 
         # Model inference
-        output_power = model_inference_power(model, input, input_surface, aux_constants)
+        output_power = model_inference_power(
+            model,
+            input,
+            input_surface,
+            aux_constants,
+            cached=cfg.PG.FEATURE_CACHE.ENABLED,
+        )
 
-        # Load lsm and calculate loss
-        lsm_expanded = load_land_sea_mask(output_power.device)
-        loss = calculate_loss(output_power, target_power, criterion, lsm_expanded)
+        # Calculate loss on the sea points
+        sea_indices = utils_data.getSeaIndices(
+            output_power.device, roi=utils_data.isRoi(output_power)
+        )
+        loss = calculate_loss(output_power, target_power, criterion, sea_indices)
 
         # Backpropagation
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            # Loss scaling for fp16 (passes through if the scaler is disabled)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
         epoch_loss += loss.item()
 
     epoch_loss /= len(train_loader)
@@ -577,7 +666,8 @@ def validate(
     with torch.no_grad():
         model.eval()
         val_loss = 0.0
-        for id, val_data in enumerate(val_loader, 0):
+        prefetcher = utils_data.DataPrefetcher(val_loader, device, indices=(0, 1, 3))
+        for id, val_data in enumerate(prefetcher, 0):
             (
                 input_upper_val,
                 input_surface_val,
@@ -587,18 +677,19 @@ def validate(
                 target_surface_val,
                 periods_val,
             ) = val_data
-            input_upper_val, input_surface_val, target_power_val = (
-                input_upper_val.to(device),
-                input_surface_val.to(device),
-                target_power_val.to(device),
-            )
             print(f"(V) Processing batch {id + 1}/{len(val_loader)}")
             output_power_val = model_inference_power(
-                model, input_upper_val, input_surface_val, aux_constants
+                model,
+                input_upper_val,
+                input_surface_val,
+                aux_constants,
+                cached=cfg.PG.FEATURE_CACHE.ENABLED,
+            )
+            sea_indices = utils_data.getSeaIndices(
+                output_power_val.device, roi=utils_data.isRoi(output_power_val)
             )
-            lsm_expanded = load_land_sea_mask(output_power_val.device)
             loss = calculate_loss(
-                output_power_val, target_power_val, criterion, lsm_expanded
+                output_power_val, target_power_val, criterion, sea_indices
             )
             val_loss += loss.item()
 
@@ -608,8 +699,14 @@ def validate(
             logger.info("Validate at Epoch {} : {:.3f}".format(epoch, val_loss))
             png_path = os.path.join(res_path, "png_training")
             utils.mkdirs(png_path)
+            input_upper_val, input_surface_val = load_missing_era5(
+                val_loader, input_upper_val, input_surface_val, periods_val[0][0]
+            )
+            target_upper_val, target_surface_val = load_missing_era5(
+                val_loader, target_upper_val, target_surface_val, periods_val[1][0]
+            )
             visualize(
-                output_power_val,
+                utils_data.toGlobalGrid(output_power_val),
                 target_power_val,
                 input_surface_val,
                 input_upper_val,
@@ -0,0 +1,43 @@
+# Forward pass latency of an EarthSpecificLayer, eager vs. compiled with compile_blocks (see cfg.PG.COMPILE), on the
+# CPU by default. Run with: python -m pangu_power.tests.benchmark_compile_blocks
+
+import time
+
+import torch
+
+from ..era5_data.config import cfg
+from ..models.layers import EarthSpecificLayer, compile_blocks, set_attention_backend
+
+
+def mean_forward_time(model, x, Z, H, W, n):
+    """Mean time of n forward passes, after a warm-up pass (which also compiles the blocks)"""
+    with torch.no_grad():
+        model(x, Z, H, W)
+        start = time.perf_counter()
+        for _ in range(n):
+            model(x, Z, H, W)
+        if x.device.type == "cuda":
+            torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - start) / n
+
+
+def benchmark_compile_blocks(device="cpu", n=3, W=48):
+    """Latency of an EarthSpecificLayer of the second stage of Pangu (2 blocks, dim 384, 8 x 91 x W tokens, W = 180 in
+    Pangu, fewer longitudes keep the compilation on the CPU short), eager and compiled, with the configured attention
+    backend and window partition."""
+    device = torch.device(device)
+    model = EarthSpecificLayer(2, 384, [0.0, 0.0], 12, device).to(device).eval()
+    set_attention_backend(model, cfg.PG.ATTENTION_BACKEND)
+    x = torch.randn(1, 8 * 91 * W, 384, device=device)
+
+    eager_time = mean_forward_time(model, x, 8, 91, W, n)
+    compile_blocks(model)
+    compiled_time = mean_forward_time(model, x, 8, 91, W, n)
+    print(
+        f"Forward pass on {device.type}: eager {eager_time:.2f}s, compiled {compiled_time:.2f}s "
+        f"({eager_time / compiled_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    benchmark_compile_blocks()
@@ -0,0 +1,47 @@
+# Latency of the power curve of the formula baseline, lookup table vs. searchsorted (see cfg.POWER.CURVE_LUT).
+# Run with: python -m pangu_power.tests.benchmark_power_curve
+
+import time
+
+import torch
+
+from ..era5_data import utils_data
+from ..models.baseline_formula import BaselineFormula
+
+
+def benchmark_power_curve(
+    device: torch.device, shape=(1, 16, 721, 1440), repeats: int = 20
+) -> None:
+    """Compares the lookup table with the searchsorted interpolation (latency and largest difference), for the
+    offshore and the onshore power curve."""
+    wind_speed = torch.rand(shape, device=device) * 30.0
+    # Knots and the cut-out exactly
+    wind_speed.view(-1)[:61] = torch.arange(61, device=device) * 0.5
+
+    for offshore in (True, False):
+        formula = BaselineFormula(
+            device, utils_data.loadWindPowerCurveCapacityFactor(offshore)
+        )
+        outputs = {}
+        for use_lut in (False, True):
+            formula.use_lut = use_lut
+            outputs[use_lut] = formula._capacity_factor(wind_speed)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                formula._capacity_factor(wind_speed)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time.perf_counter() - start) / repeats
+            name = "lookup table" if use_lut else "searchsorted"
+            print(
+                f"{'offshore' if offshore else 'onshore'} {name}: {elapsed * 1e3:.2f} ms"
+            )
+
+        difference = (outputs[True] - outputs[False]).abs().max()
+        print(f"Largest difference: {difference.item():.2e}")
+
+
+if __name__ == "__main__":
+    benchmark_power_curve(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
@@ -0,0 +1,55 @@
+# Bytes moved and time of the window partition of an EarthSpecificBlock, gather vs. reference (see
+# cfg.PG.GATHER_WINDOW_PARTITION). Run with: python -m pangu_power.tests.benchmark_window_partition
+
+import time
+
+import torch
+from torch.utils import _pytree as pytree
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from ..models.layers import EarthSpecificBlock
+
+
+class _BytesMoved(TorchDispatchMode):
+    """Counts the bytes of the tensors read and written by all operations that are not views (an upper bound for
+    indexing operations, which only read the indexed elements)"""
+
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if not func.is_view:
+            tensors = pytree.tree_leaves((args, kwargs, out))
+            self.bytes += sum(t.nbytes for t in tensors if isinstance(t, torch.Tensor))
+        return out
+
+
+def benchmark_window_partition(device="cpu", n=5):
+    """Bytes moved and time of the window partition and reverse of an EarthSpecificBlock (dim 192, rolled), for the
+    gather and the reference implementation. The attention is replaced by the identity, so both must return x."""
+    block = EarthSpecificBlock(192, 0, 6, device=device).to(device)
+    block._attention = lambda x_window, mask: x_window
+    x = torch.randn(1, 8 * 181 * 360, 192, device=device)
+    mask = block.gen_mask(x, 8, 181)
+
+    for name, fn in [
+        ("reference", block._window_attention_reference),
+        ("gather", block._window_attention_gather),
+    ]:
+        with torch.no_grad():
+            with _BytesMoved() as counter:
+                output = fn(x, 8, 181, 360, True, mask)
+            start = time.perf_counter()
+            for _ in range(n):
+                fn(x, 8, 181, 360, True, mask)
+            elapsed = (time.perf_counter() - start) / n
+        print(
+            f"{name}: {counter.bytes / 1024**3:.2f} GiB moved, {elapsed * 1000:.1f} ms, "
+            f"max abs difference to x {(output - x).abs().max().item():.1e}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_window_partition()
@@ -0,0 +1,43 @@
+import torch
+
+from ..era5_data.config import cfg
+from ..models.baseline_formula import BaselineFormula
+
+
+def test_forward_all():
+    """forward_all matches forward on every pressure level and the surface"""
+    formula = BaselineFormula(torch.device("cpu"))
+    upper = torch.randn(2, 5, 13, 8, 16) * 10
+    surface = torch.randn(2, 4, 8, 16) * 10
+    output = formula.forward_all(upper, surface)
+
+    names = formula.level_names()
+    assert output.shape == (2, len(names), 8, 16)
+    assert len(names) == 13 + 1 + len(cfg.POWER.HUB_HEIGHTS)
+    for z in range(13):
+        torch.testing.assert_close(output[:, z], formula(upper, surface, z=z))
+    torch.testing.assert_close(
+        output[:, names.index("surface")], formula(upper, surface, use_surface=True)
+    )
+
+
+def test_lut_parity():
+    """The lookup table gives the searchsorted result on the knots of the power curve (including the cut-out),
+    outside of its range and, up to rounding, in between"""
+    formula = BaselineFormula(torch.device("cpu"))
+    knots = formula.wind_speeds
+    wind_speed = torch.cat(
+        (knots, torch.tensor([-1.0, 0.25, 24.75, 24.9999, 25.0001, 30.0, 600.0]))
+    )
+    random_wind_speed = torch.rand(10000) * 30.0
+
+    formula.use_lut = False
+    expected = formula._capacity_factor(wind_speed)
+    random_expected = formula._capacity_factor(random_wind_speed)
+    formula.use_lut = True
+    torch.testing.assert_close(
+        formula._capacity_factor(wind_speed), expected, rtol=0, atol=0
+    )
+    torch.testing.assert_close(
+        formula._capacity_factor(random_wind_speed), random_expected, rtol=0, atol=1e-6
+    )
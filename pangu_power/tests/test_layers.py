@@ -0,0 +1,292 @@
+import copy
+import pickle
+
+import pytest
+import torch
+from torch import nn
+
+from ..era5_data.config import cfg
+from ..models.layers import (
+    DownSample,
+    EarthAttention3D,
+    EarthSpecificLayer,
+    LayerNorm,
+    PatchEmbedding_pretrain,
+    PatchRecoveryPowerAll,
+    PatchRecoveryPowerAll_2,
+    PatchRecoveryPowerAllWithClippedReLU,
+    PatchRecoveryPowerSurface,
+    PatchRecoveryPowerSurface_2,
+    PatchRecoveryPowerUpper,
+    PatchRecoveryPowerUpper_2,
+    PowerConv,
+    UpSample,
+    clipped_relu,
+    compile_blocks,
+    set_attention_backend,
+    shifted_window_mask,
+)
+
+
+def legacy_copy(module, attributes):
+    """Pickle round trip of module without the given attributes, like a model saved before they existed"""
+    for name in attributes:
+        del module.__dict__[name]
+    return pickle.loads(pickle.dumps(module))
+
+
+def test_power_conv_legacy_pickle():
+    model = PowerConv(roi=False).eval()
+    upper = torch.randn(1, 5, 13, 16, 32)
+    surface = torch.randn(1, 4, 16, 32)
+    with torch.no_grad():
+        output = model(upper, surface)
+        legacy = legacy_copy(model, ["roi", "halo", "upper_index", "surface_index"])
+        torch.testing.assert_close(legacy(upper, surface), output)
+
+
+def test_patch_recovery_legacy_pickle():
+    model = PatchRecoveryPowerAll(384, roi=False)
+    x = torch.randn(1, 8 * 4 * 6, 384)
+    with torch.no_grad():
+        output = model(x, 8, 4, 6)
+        legacy = legacy_copy(model, ["roi"])
+        torch.testing.assert_close(legacy(x, 8, 4, 6), output)
+
+
+def test_attention_legacy_pickle():
+    model = EarthAttention3D(384, 12, 0.0, (2, 6, 12), torch.device("cpu"))
+    x = torch.randn(2, 64, 144, 384)
+    mask = torch.zeros(2, 64, 144, 144).masked_fill(
+        torch.rand(2, 64, 144, 144) < 0.1, -100
+    )
+    with torch.no_grad():
+        output = model(x, mask)
+        legacy = legacy_copy(model, ["backend", "cache_bias", "_bias_cache"])
+        torch.testing.assert_close(legacy(x, mask), output)
+
+
+def test_layer_norm_legacy_pickle():
+    model = DownSample(192)
+    legacy_norm = nn.LayerNorm(4 * 192)
+    legacy_norm.load_state_dict(model.norm.state_dict())
+    model.norm = legacy_norm
+    x = torch.randn(1, 8 * 5 * 8, 192)
+    with torch.no_grad():
+        output = model(x, 8, 5, 8)
+        legacy = pickle.loads(pickle.dumps(model))
+        assert type(legacy.norm) is LayerNorm
+        torch.testing.assert_close(legacy(x, 8, 5, 8), output)
+
+
+def test_earth_specific_layer_legacy_pickle():
+    model = EarthSpecificLayer(2, 384, [0.0, 0.0], 12, torch.device("cpu")).eval()
+    x = torch.randn(1, 8 * 91 * 24, 384)
+    with torch.no_grad():
+        output = model(x, 8, 91, 24)
+        for block in model.blocks:
+            del block.__dict__["checkpoint_attention"]
+            del block.__dict__["gather_partition"]
+        model.use_checkpoint = True
+        legacy = legacy_copy(model, ["checkpoint_policy"])
+        assert legacy.checkpoint_policy == "all"
+        torch.testing.assert_close(legacy(x, 8, 91, 24), output)
+
+
+def test_patch_embedding_legacy_pickle():
+    model = PatchEmbedding_pretrain((2, 4, 4), 192)
+    legacy = legacy_copy(model, ["fold_normalization", "_folded"])
+    assert legacy.fold_normalization == cfg.PG.FOLD_PATCH_EMBEDDING
+    assert legacy._folded is None
+
+
+def test_patch_embedding_folded():
+    """The folded patch embedding matches the reference up to the fp32 cancellation of the folded normalization
+    offsets (statistics with mean / std up to ~20, like the ERA5 variables)"""
+    torch.manual_seed(0)
+    model = PatchEmbedding_pretrain((2, 4, 4), 192).eval()
+    surface_mean = torch.rand(4) * 1000
+    surface_std = surface_mean * (torch.rand(4) * 0.15 + 0.05) + 1
+    upper_mean = torch.rand(13, 1, 1, 5) * 1000
+    upper_std = upper_mean * (torch.rand(13, 1, 1, 5) * 0.15 + 0.05) + 1
+    statistics = (surface_mean, surface_std, upper_mean, upper_std)
+    maps = torch.randn(1, 3, 724, 1440)
+    const_h = torch.randn(1, 1, 1, 13, 721, 1440)
+
+    # Inputs around the means, the upper-air statistics are ordered [level (reversed), 1, 1, variable]
+    surface = torch.randn(1, 4, 721, 1440) * surface_std.view(4, 1, 1)
+    surface += surface_mean.view(4, 1, 1)
+    upper = torch.randn(1, 5, 13, 721, 1440)
+    upper *= upper_std.permute(3, 0, 1, 2).flip(1)
+    upper += upper_mean.permute(3, 0, 1, 2).flip(1)
+    with torch.no_grad():
+        reference = model.forward_reference(upper, surface, statistics, maps, const_h)
+        folded = model.forward_folded(upper, surface, statistics, maps, const_h)
+    torch.testing.assert_close(folded, reference, rtol=1e-4, atol=1e-4)
+
+
+def test_window_partition_gather():
+    model = EarthSpecificLayer(2, 384, [0.0, 0.0], 12, torch.device("cpu")).eval()
+    x = torch.randn(1, 8 * 91 * 24, 384)
+    with torch.no_grad():
+        for block in model.blocks:
+            block.gather_partition = False
+        reference = model(x, 8, 91, 24)
+        for block in model.blocks:
+            block.gather_partition = True
+        torch.testing.assert_close(model(x, 8, 91, 24), reference)
+
+
+@pytest.mark.parametrize("backend", ["math", "sdpa"])
+@pytest.mark.parametrize("gather_partition", [True, False])
+def test_compile_blocks(gather_partition, backend):
+    """compile_blocks and a forward pass for all window partitions and attention backends (the defaults are
+    cfg.PG.GATHER_WINDOW_PARTITION and cfg.PG.ATTENTION_BACKEND)"""
+    model = EarthSpecificLayer(2, 384, [0.0, 0.0], 12, torch.device("cpu")).eval()
+    for block in model.blocks:
+        block.gather_partition = gather_partition
+    set_attention_backend(model, backend)
+    x = torch.randn(1, 8 * 91 * 12, 384)
+    with torch.no_grad():
+        output = model(x, 8, 91, 12)
+        compile_blocks(model)
+        torch.testing.assert_close(model(x, 8, 91, 12), output, rtol=1e-4, atol=1e-4)
+
+
+def test_compiled_copies():
+    """Compiled models can be deep-copied and pickled (e.g. the best model), the copies run eagerly"""
+    model = EarthSpecificLayer(2, 384, [0.0, 0.0], 12, torch.device("cpu")).eval()
+    compile_blocks(model)
+    x = torch.randn(1, 8 * 91 * 12, 384)
+    with torch.no_grad():
+        output = model(x, 8, 91, 12)
+        for copied in [copy.deepcopy(model), pickle.loads(pickle.dumps(model))]:
+            assert copied.state_dict().keys() == model.state_dict().keys()
+            torch.testing.assert_close(
+                copied(x, 8, 91, 12), output, rtol=1e-4, atol=1e-4
+            )
+
+
+@pytest.mark.parametrize("roi", [False, True])
+def test_power_conv_fuse(roi):
+    """Parity of the fused and the unfused PowerConv (eval mode, non-trivial BatchNorm statistics), on the full
+    grid and in ROI mode (with a halo)"""
+    model = PowerConv(
+        out_channels_list=[64, 32, 16, 1], kernel_size=3, padding=1, roi=roi
+    )
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            nn.init.uniform_(module.weight, 0.5, 1.5)
+            nn.init.uniform_(module.bias, -0.5, 0.5)
+    model.eval()
+
+    # Only the used variables, the full grid is needed for the ROI
+    upper = torch.randn(1, 2, 13, 721, 1440)
+    surface = torch.randn(1, 2, 721, 1440)
+    with torch.no_grad():
+        output = model(upper, surface)
+        fused_output = copy.deepcopy(model).fuse()(upper, surface)
+    torch.testing.assert_close(fused_output, output, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("shifted", [False, True])
+def test_attention_backends(shifted):
+    """The math and the sdpa attention backend give the same outputs, without and with the mask of the shifted
+    windows (the mask of a Z=8, H=96 layer, broadcast over the windows along the longitude)"""
+    model = EarthAttention3D(384, 12, 0.0, (2, 6, 12), torch.device("cpu")).eval()
+    x = torch.randn(2, 64, 144, 384)
+    mask = (
+        shifted_window_mask(8, 96, (2, 6, 12), 64, torch.device("cpu"))
+        if shifted
+        else None
+    )
+    with torch.no_grad():
+        set_attention_backend(model, "math")
+        output = model(x, mask)
+        set_attention_backend(model, "sdpa")
+        torch.testing.assert_close(model(x, mask), output, rtol=1e-5, atol=1e-5)
+
+
+HEADS = [
+    PatchRecoveryPowerSurface,
+    PatchRecoveryPowerSurface_2,
+    PatchRecoveryPowerUpper,
+    PatchRecoveryPowerUpper_2,
+    PatchRecoveryPowerAll,
+    PatchRecoveryPowerAll_2,
+    PatchRecoveryPowerAllWithClippedReLU,
+]
+
+
+@pytest.mark.parametrize(
+    "make_model, dim, shape",
+    [
+        pytest.param(
+            lambda: EarthSpecificLayer(2, 384, [0.0, 0.0], 12, torch.device("cpu")),
+            384,
+            (8, 91, 12),
+            id="EarthSpecificLayer",
+        ),
+        pytest.param(lambda: DownSample(192), 192, (8, 5, 8), id="DownSample"),
+        pytest.param(lambda: UpSample(384, 192), 384, (8, 3, 4), id="UpSample"),
+    ]
+    + [
+        pytest.param(lambda head=head: head(384), 384, (8, 4, 6), id=head.__name__)
+        for head in HEADS
+    ],
+)
+def test_batched(make_model, dim, shape):
+    """A batch of two samples gives the same outputs as the samples run one by one"""
+    model = make_model().eval()
+    Z, H, W = shape
+    x = torch.randn(2, Z * H * W, dim)
+    with torch.no_grad():
+        output = model(x, Z, H, W)
+        single_outputs = torch.cat([model(x[i : i + 1], Z, H, W) for i in range(2)])
+    torch.testing.assert_close(output, single_outputs)
+
+
+def reference_recovery(x, Z, H, W, conv, variables, patch_depth, levels):
+    """Pre-refactor patch recovery of the power heads (for a grid of H x W patches): all output channels of all tokens
+    of the levels are recovered, then the first variable on the first level is sliced out"""
+    x = torch.permute(x, (0, 2, 1))
+    x = x.reshape(x.shape[0], x.shape[1], Z, H, W)[:, :, levels]
+    num_levels = x.shape[2]
+    output = conv(x.reshape(x.shape[0], x.shape[1], -1))
+    output = output.reshape(
+        output.shape[0], variables, patch_depth, 4, 4, num_levels, H, W
+    )
+    output = torch.permute(output, (0, 1, 5, 2, 6, 3, 7, 4))
+    output = output.reshape(
+        output.shape[0], variables, num_levels * patch_depth, 4 * H, 4 * W
+    )
+    return output[:, 0:1, 0, : 4 * H - 3, :]
+
+
+@pytest.mark.parametrize(
+    "head, variables, patch_depth, levels, clipped",
+    [
+        (PatchRecoveryPowerSurface, 1, 1, slice(0, 1), False),
+        (PatchRecoveryPowerSurface_2, 4, 1, slice(0, 1), True),
+        (PatchRecoveryPowerUpper, 1, 2, slice(1, None), False),
+        (PatchRecoveryPowerUpper_2, 5, 2, slice(1, None), True),
+        (PatchRecoveryPowerAll, 1, 1, slice(None), False),
+        (PatchRecoveryPowerAll_2, 5, 2, slice(None), True),
+        (PatchRecoveryPowerAllWithClippedReLU, 1, 1, slice(None), True),
+    ],
+    ids=lambda param: param.__name__ if isinstance(param, type) else None,
+)
+def test_patch_recovery(head, variables, patch_depth, levels, clipped):
+    """The power heads only recover the pixels they return, with the same outputs as the pre-refactor heads"""
+    model = head(384)
+    conv = model.conv_surface if hasattr(model, "conv_surface") else model.conv
+    x = torch.randn(2, 8 * 4 * 6, 384)
+    with torch.no_grad():
+        reference = reference_recovery(x, 8, 4, 6, conv, variables, patch_depth, levels)
+        output = model(x, 8, 4, 6)
+    if clipped:
+        reference = clipped_relu(reference)
+    assert output.shape == (2, 1, 13, 24)
+    torch.testing.assert_close(output, reference)
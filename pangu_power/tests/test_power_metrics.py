@@ -0,0 +1,30 @@
+import math
+
+import torch
+
+from ..models.power_metrics import PowerScoreAccumulator
+
+
+def test_scores():
+    sea_indices = torch.arange(0, 721 * 1440, 97)
+    metrics = PowerScoreAccumulator(sea_indices, torch.rand(721, 1440))
+    output = torch.rand(2, 1, 721, 1440)
+    target = torch.rand(2, 1, 721, 1440)
+    metrics.update(output, target, ["2020-01-01T00", "2020-01-02T00"])
+
+    error = (output - target).view(2, -1)[:, sea_indices]
+    mean_scores = metrics.mean_scores()
+    assert math.isclose(
+        mean_scores["rmse"], error.square().mean(-1).sqrt().mean().item(), rel_tol=1e-5
+    )
+    assert math.isclose(mean_scores["bias"], error.mean().item(), abs_tol=1e-6)
+    torch.testing.assert_close(
+        metrics.error_maps()["mae"].view(-1)[sea_indices], error.abs().mean(0)
+    )
+
+
+def test_scores_without_samples():
+    """An empty test loader gives NaN scores instead of dividing by zero"""
+    metrics = PowerScoreAccumulator(torch.arange(10), torch.rand(721, 1440))
+    assert all(math.isnan(value) for value in metrics.mean_scores().values())
+    assert all(grid.isnan().all() for grid in metrics.error_maps().values())
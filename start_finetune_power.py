@@ -2,7 +2,11 @@ import torch
 from torch import multiprocessing as mp
 from random import randrange
 import argparse
-from pangu_power.finetune.finetune_power import main, test_best_model
+from pangu_power.finetune.finetune_power import (
+    main,
+    test_best_model,
+    compare_dataloaders,
+)
 
 
 if __name__ == "__main__":
@@ -19,9 +23,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--start_epoch", type=int, default=1, help="Starting epoch for training"
     )
+    parser.add_argument(
+        "--benchmark_dataloader",
+        action="store_true",
+        help="Compare the throughput of the single-process and the configured DataLoader, then exit",
+    )
 
     args = parser.parse_args()
 
+    if args.benchmark_dataloader:
+        compare_dataloaders(args)
+        raise SystemExit(0)
+
     world_size = len(args.gpu_list)
     print(f"World size: {world_size if args.dist else 1}")
 